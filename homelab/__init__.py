@@ -0,0 +1,16 @@
+"""
+Shared pieces of the homelab scripts: jobs with timed phases, streaming
+subprocesses, notifiers and metrics, database snapshots, compressed and
+encrypted archives, a deduplicating backup repository, and the runner
+behind python3 -m homelab run <job>.
+
+Scripts in subdirectories add the repository root to sys.path to import it.
+"""
+from homelab.archive import exclude, gpg_encrypt
+from homelab.compress import Compressor, compress, compressor
+from homelab.database import backup_database, find_databases
+from homelab.job import Job, Phase
+from homelab.metrics import JsonMetrics, PrometheusMetrics
+from homelab.notify import DiscordNotifier, Notifier, PrintNotifier
+from homelab.process import (CommandFailed, CommandResult, pipe_through,
+                             run_command)
@@ -0,0 +1,47 @@
+"""
+python3 -m homelab run [-c jobs.conf] JOB... runs jobs with their
+dependencies, python3 -m homelab list shows them.
+"""
+import argparse
+import sys
+
+from homelab import runner
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m homelab")
+    parser.add_argument("-c", "--conf", default=runner.DEFAULT_CONF,
+                        metavar="CONFIG",
+                        help="Jobs configuration file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser(
+        "run", help="Run jobs, after the jobs they come after")
+    run_parser.add_argument("jobs", nargs="+", metavar="JOB",
+                            help='Jobs to run, "all" for every job')
+    run_parser.add_argument("-j", "--concurrency", type=int,
+                            help="Jobs to run at once (overrides config)")
+    run_parser.add_argument("--no-deps", action="store_false",
+                            dest="with_dependencies",
+                            help="Do not run the jobs they come after")
+    run_parser.add_argument("-n", "--dry-run", action="store_true",
+                            help="Only print what would run, in order")
+    commands.add_parser("list", help="List the jobs and their order")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "list":
+            settings, specs = runner.load_jobs(args.conf)
+            for name in runner.select(specs, ["all"]):
+                after = specs[name].after
+                print(name + (f" (after {', '.join(after)})" if after else ""))
+            return
+        ok = runner.run(args.conf, args.jobs, args.with_dependencies,
+                        args.dry_run, args.concurrency)
+    except (OSError, ValueError) as e:
+        print(f"homelab: {e}", file=sys.stderr)
+        sys.exit(2)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
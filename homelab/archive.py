@@ -0,0 +1,68 @@
+"""
+Streaming backup archives: tar straight into a compressor and an encryption
+process and on into any writable file, local or SFTP, with no staging copies
+on disk.
+
+    with open(path, "wb") as out, gpg_encrypt(out, passphrase) as plain, \
+            compress(plain, compressor("zstd")) as stream, \
+            tarfile.open(fileobj=stream, mode="w|") as tar:
+        tar.add(data_dir, arcname=".", filter=exclude(["*.tmp"]))
+"""
+import fnmatch
+import os
+from contextlib import contextmanager
+
+from homelab.process import pipe_through
+
+
+class CountingWriter:
+    """ Pass writes on to output, counting the bytes. """
+    def __init__(self, output):
+        self.output = output
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.output.write(data)
+
+    def flush(self):
+        self.output.flush()
+
+
+def exclude(patterns):
+    """ A tarfile filter leaving out members whose name matches a pattern. """
+    def tar_filter(member):
+        name = os.path.basename(member.name)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            return None
+        return member
+    return tar_filter
+
+
+@contextmanager
+def gpg_encrypt(output, passphrase, cipher="AES256", chunk_size=1 << 20):
+    """
+    Yield a file to write plaintext to. gpg encrypts it symmetrically with
+    passphrase and cipher, with gpg's integrity protection, and the result
+    is written to output. Decrypt with gpg --decrypt. The passphrase goes
+    to gpg through a pipe, not the command line. gpg's own compression is
+    off, the data is expected to be compressed already.
+
+    Raises CommandFailed if gpg fails, and whatever output.write raises.
+    """
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, passphrase.encode() + b"\n")
+    os.close(write_fd)
+    try:
+        with pipe_through(
+                ["gpg", "--batch", "--yes", "--quiet", "--pinentry-mode",
+                 "loopback", "--passphrase-fd", str(read_fd), "--symmetric",
+                 "--cipher-algo", cipher, "--compress-algo", "none",
+                 "--output", "-"],
+                output, chunk_size, pass_fds=(read_fd,)) as plain:
+            os.close(read_fd)
+            read_fd = None
+            yield plain
+    finally:
+        if read_fd is not None:
+            os.close(read_fd)
@@ -0,0 +1,157 @@
+"""
+Compression for backup archives: pick a format, a level and a number of
+threads, and the fastest installed tool does it. The multi-threaded ones
+(zstd, xz, pigz, pbzip2) come first. Without any, Python's own modules
+compress on one core.
+
+    with compress(output, compressor("zstd", level=3)) as stream, \
+            tarfile.open(fileobj=stream, mode="w|") as tar:
+        tar.add(path)
+    print(stream.summary())
+"""
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from homelab.archive import CountingWriter
+from homelab.process import pipe_through
+
+# Extension, default level, the tools to try in order, and the Python module
+# with the name of its level argument, for every format
+FORMATS = {
+    "zstd": (".zst", 3, ["zstd"], None),
+    "xz": (".xz", 6, ["xz"], (lzma, "preset")),
+    "gzip": (".gz", 6, ["pigz", "gzip"], (gzip, "compresslevel")),
+    "bzip2": (".bz2", 9, ["pbzip2", "bzip2"], (bz2, "compresslevel")),
+    "none": ("", 0, [], None),
+}
+# What auto uses: multi-threaded tools first, then the single-threaded ones
+AUTO_ORDER = [("zstd", "zstd"), ("gzip", "pigz"), ("bzip2", "pbzip2"),
+              ("xz", "xz"), ("gzip", "gzip")]
+
+
+class Compressor:
+    """
+    A format and the tool that compresses to it, a command line tool or
+    None for the Python module. threads 0 uses every core.
+    """
+    def __init__(self, format, level, threads, tool):
+        self.format = format
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.tool = tool
+        self.extension = FORMATS[format][0]
+
+    @property
+    def command(self):
+        if self.tool is None:
+            return None
+        level = f"-{self.level}"
+        if self.tool == "zstd":
+            ultra = ["--ultra"] if self.level > 19 else []
+            return ["zstd", "-q", "-c", *ultra, level, f"-T{self.threads}"]
+        if self.tool == "xz":
+            return ["xz", "-c", level, f"-T{self.threads}"]
+        if self.tool == "pigz":
+            return ["pigz", "-c", level, "-p", str(self.threads)]
+        if self.tool == "pbzip2":
+            return ["pbzip2", "-c", level, f"-p{self.threads}"]
+        return [self.tool, "-c", level]
+
+    def __str__(self):
+        if self.format == "none":
+            return "none"
+        if self.tool is None:
+            return f"{self.format} -{self.level} (python)"
+        if self.tool in ("gzip", "bzip2"):
+            return f"{self.tool} -{self.level}"
+        return f"{self.tool} -{self.level} x{self.threads}"
+
+
+def compressor(format="auto", level=None, threads=0):
+    """
+    The Compressor for format ("auto" for the fastest installed one), at
+    level (the format's default if None) with threads threads. Raises
+    ValueError for unknown formats and FileNotFoundError for zstd if it is
+    not installed.
+    """
+    if format == "auto":
+        for candidate, tool in AUTO_ORDER:
+            if shutil.which(tool):
+                format = candidate
+                break
+        else:
+            format = "gzip"
+    if format not in FORMATS:
+        raise ValueError(f"unknown compression {format}, use one of "
+                         + ", ".join(["auto", *FORMATS]))
+    extension, default_level, tools, module = FORMATS[format]
+    tool = next((t for t in tools if shutil.which(t)), None)
+    if tool is None and tools and module is None:
+        raise FileNotFoundError(f"{format} is not installed")
+    return Compressor(format, default_level if level is None else level,
+                      threads, tool)
+
+
+class CompressStream:
+    """
+    What compress() yields: write the data to it. Counts the bytes going in
+    and out and the time, for the report once the block is done.
+    """
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.file = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    @property
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 0
+
+    @property
+    def rate(self):
+        """ MB/s of data compressed. """
+        return self.bytes_in / self.seconds / 1e6 if self.seconds else 0
+
+    def summary(self):
+        return (f"{self.compressor}, ratio {self.ratio:.2f}, "
+                f"{self.rate:.1f} MB/s")
+
+
+@contextmanager
+def compress(output, compressor, chunk_size=1 << 20):
+    """
+    Yield a CompressStream that compresses what is written to it with
+    compressor into output.
+    """
+    stream = CompressStream(compressor)
+    counter = CountingWriter(output)
+    started = time.monotonic()
+    try:
+        if compressor.command:
+            with pipe_through(compressor.command, counter,
+                              chunk_size) as stream.file:
+                yield stream
+        elif compressor.format != "none":
+            module, level_arg = FORMATS[compressor.format][3]
+            with module.open(counter, "wb",
+                             **{level_arg: compressor.level}) as stream.file:
+                yield stream
+        else:
+            stream.file = counter
+            yield stream
+    finally:
+        stream.seconds = time.monotonic() - started
+        stream.bytes_out = counter.bytes
@@ -0,0 +1,131 @@
+"""
+Consistent copies of SQLite databases that are in use, for backups.
+"""
+import fnmatch
+import os
+import sqlite3
+import time
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Files SQLite keeps next to a database while it is in use
+SIDE_FILES = ("-wal", "-shm", "-journal")
+# Times a copy in steps may start over before it is done in one step
+MAX_RESTARTS = 3
+
+
+class _Restarted(Exception):
+    pass
+
+
+def backup_database(source, target, pages_per_step=-1, progress=None,
+                    vacuum=False, integrity_check=True, timeout=30):
+    """
+    Copy the SQLite database source to target with SQLite's online backup
+    API. The copy is a consistent snapshot even while other processes
+    write to source. progress(copied_pages, total_pages) is called after
+    every step.
+
+    WAL databases are always copied in one step: the read transaction does
+    not block writers. Otherwise the copy goes in steps of pages_per_step
+    pages (-1 for one step), so writers are only blocked for a step at a
+    time. SQLite starts a copy in steps over whenever source changes
+    between two steps, which on a busy database never ends, so after
+    MAX_RESTARTS restarts it is done in one step.
+
+    The copy uses a rollback journal instead of WAL, so it is one
+    self-contained file. With vacuum it is compacted with VACUUM INTO.
+    With integrity_check, a copy that fails PRAGMA integrity_check raises
+    sqlite3.DatabaseError. target only appears once the copy is complete.
+
+    Returns a dict with the pages copied, the size of target in bytes and
+    the seconds it took.
+    """
+    started = time.monotonic()
+    tmp_target = target + ".tmp"
+    for path in (tmp_target, tmp_target + ".vacuum"):
+        if os.path.exists(path):
+            os.remove(path)
+    pages = 0
+
+    restarts = 0
+    last_remaining = None
+
+    def step(status, remaining, total):
+        nonlocal pages, restarts, last_remaining
+        pages = total
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _Restarted()
+        last_remaining = remaining
+        if progress:
+            progress(total - remaining, total)
+
+    src = sqlite3.connect(source, timeout=timeout)
+    dst = sqlite3.connect(tmp_target)
+    try:
+        mode = src.execute("PRAGMA journal_mode").fetchone()[0]
+        if mode.lower() == "wal":
+            pages_per_step = -1
+        try:
+            src.backup(dst, pages=pages_per_step, progress=step, sleep=0)
+        except _Restarted:
+            print(f"{source} keeps changing, copying it in one step")
+            src.backup(dst, pages=-1, progress=step, sleep=0)
+        dst.execute("PRAGMA journal_mode=DELETE")
+        if vacuum:
+            dst.execute("VACUUM INTO ?", (tmp_target + ".vacuum",))
+    finally:
+        dst.close()
+        src.close()
+    if vacuum:
+        os.replace(tmp_target + ".vacuum", tmp_target)
+
+    if integrity_check:
+        check = sqlite3.connect(tmp_target)
+        try:
+            result = [row[0] for row in
+                      check.execute("PRAGMA integrity_check")]
+        finally:
+            check.close()
+        if result != ["ok"]:
+            os.remove(tmp_target)
+            raise sqlite3.DatabaseError(
+                f"integrity_check of the copy of {source} failed: "
+                + "; ".join(result[:10]))
+
+    os.replace(tmp_target, target)
+    return {
+        "pages": pages,
+        "bytes": os.path.getsize(target),
+        "seconds": time.monotonic() - started,
+    }
+
+
+def find_databases(roots, patterns=("*.db",)):
+    """
+    The SQLite databases at or below roots: files whose name matches one of
+    patterns and that start with the SQLite header. Dated copies like
+    name.db-2024-01-01 do not match.
+    """
+    found = []
+    for root in roots:
+        if os.path.isfile(root):
+            candidates = [root]
+        else:
+            candidates = [os.path.join(directory, name)
+                          for directory, _, names in os.walk(root)
+                          for name in names]
+        for path in candidates:
+            name = os.path.basename(path)
+            if (os.path.islink(path) or not any(
+                    fnmatch.fnmatch(name, p) for p in patterns)):
+                continue
+            try:
+                with open(path, "rb") as f:
+                    if f.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                        found.append(path)
+            except OSError:
+                continue
+    return sorted(found)
+
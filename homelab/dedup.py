@@ -0,0 +1,581 @@
+"""
+A deduplicating backup repository. Files are cut into content-defined
+chunks, every chunk is stored once under its SHA-256, and each backup is a
+snapshot manifest listing the chunks of its files. A backup only reads the
+files that changed since the last one and only writes the chunks the
+repository does not have yet.
+
+    repository/
+        index.db     chunk hash -> pack, offset and length; the files cache
+        packs/       chunks appended to pack files of about 64 MB
+        snapshots/   a gzipped JSON lines manifest per backup
+        lock
+
+    with Repository(path) as repo:
+        stats = repo.backup("plex-2024-01-01", ["/var/lib/plexmediaserver"])
+        repo.prune(keep=5)
+
+python3 -m homelab.dedup REPOSITORY list|restore|check|prune ...
+"""
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_CHUNK = 256 << 10
+MAX_CHUNK = 4 << 20
+# A chunk ends after this many anchor bytes in a row, about 1 MB past
+# MIN_CHUNK on average
+ANCHOR_RUN = 19
+READ_SIZE = 8 << 20
+PACK_SIZE = 64 << 20
+# Packs are rewritten by gc once less than this much of them is still used
+REPACK_BELOW = 0.5
+
+
+def _anchor_table():
+    # Half the byte values are anchor bytes, in a fixed pseudo-random pick.
+    # 0x00 and 0xff never are, so padding does not cut chunks at MIN_CHUNK.
+    order = sorted(range(256),
+                   key=lambda b: hashlib.sha256(b"anchor" + bytes([b])).digest())
+    anchors = [b for b in order if b not in (0x00, 0xff)][:128]
+    return bytes(1 if b in anchors else 0 for b in range(256))
+
+
+ANCHOR_TABLE = _anchor_table()
+
+
+def chunks(f, min_size=MIN_CHUNK, max_size=MAX_CHUNK, anchor_run=ANCHOR_RUN):
+    """
+    Cut the binary file f into content-defined chunks and yield them. A
+    chunk ends after anchor_run anchor bytes in a row, so where it ends
+    depends only on the data before the cut, and an insert or delete only
+    changes the chunks around it. It works like a rolling hash but the cuts
+    are found with bytes.translate and bytes.find, at C speed instead of a
+    Python loop over every byte.
+    """
+    anchor = b"\x01" * anchor_run
+    buffer = bits = b""
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - pos < max_size:
+            data = f.read(READ_SIZE)
+            if data:
+                buffer = buffer[pos:] + data
+                bits = bits[pos:] + data.translate(ANCHOR_TABLE)
+                pos = 0
+                continue
+            eof = True
+        if pos == len(buffer):
+            return
+        end = min(pos + max_size, len(buffer))
+        found = bits.find(anchor, pos + min_size - anchor_run, end)
+        cut = found + anchor_run if found >= 0 else end
+        yield buffer[pos:cut]
+        pos = cut
+
+
+def encode(chunk):
+    """ The chunk as stored: zlib compressed if that is worth it. """
+    sample = chunk[:65536]
+    if len(zlib.compress(sample, 1)) < len(sample) * 0.9:
+        compressed = zlib.compress(chunk, 6)
+        if len(compressed) < len(chunk):
+            return b"z" + compressed
+    return b"r" + chunk
+
+
+def decode(blob):
+    if blob[:1] == b"z":
+        return zlib.decompress(blob[1:])
+    return blob[1:]
+
+
+def walk(root):
+    """
+    Yield (path, lstat) for root and everything below it, directories before
+    their contents. Devices, sockets and fifos are left out.
+    """
+    try:
+        st = os.lstat(root)
+    except FileNotFoundError:
+        print(f"{root} not found")
+        return
+    yield root, st
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        print(f"Cannot scan {root}: {e}")
+        return
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            yield from walk(entry.path)
+        elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+            yield entry.path, st
+
+
+class Repository:
+    """
+    A repository directory, created if it does not exist. Only one process
+    at a time can use it. workers threads read, hash and compress files in
+    parallel during a backup.
+    """
+    def __init__(self, path, workers=4, pack_size=PACK_SIZE):
+        self.path = path
+        self.workers = workers
+        self.pack_size = pack_size
+        self.lock = threading.Lock()
+        self.db = None
+
+    def __enter__(self):
+        for directory in ("packs", "snapshots"):
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+        self.lock_file = open(os.path.join(self.path, "lock"), "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise RuntimeError(f"{self.path} is in use by another process")
+        self.db = sqlite3.connect(os.path.join(self.path, "index.db"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks"
+                        " (hash BLOB PRIMARY KEY, pack INTEGER,"
+                        " offset INTEGER, length INTEGER, size INTEGER)"
+                        " WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files"
+                        " (path TEXT PRIMARY KEY, size INTEGER,"
+                        " mtime_ns INTEGER, ctime_ns INTEGER, inode INTEGER,"
+                        " chunks BLOB)")
+        self.packs = {}
+        return self
+
+    def __exit__(self, *exc_info):
+        for f in self.packs.values():
+            f.close()
+        self.db.close()
+        self.lock_file.close()
+
+    def pack_path(self, pack):
+        return os.path.join(self.path, "packs", f"{pack:08d}.pack")
+
+    def pack_ids(self):
+        return sorted(int(name.split(".")[0]) for name in
+                      os.listdir(os.path.join(self.path, "packs"))
+                      if name.endswith(".pack"))
+
+    def snapshot_path(self, name):
+        return os.path.join(self.path, "snapshots", f"{name}.jsonl.gz")
+
+    def snapshots(self):
+        """ The snapshots as (name, time), oldest first. """
+        found = []
+        for name in os.listdir(os.path.join(self.path, "snapshots")):
+            if name.endswith(".jsonl.gz"):
+                with gzip.open(os.path.join(self.path, "snapshots", name),
+                               "rt") as f:
+                    header = json.loads(f.readline())
+                found.append((header["snapshot"], header["time"]))
+        return sorted(found, key=lambda s: s[1])
+
+    def entries(self, name):
+        """ Yield the entries of snapshot name. """
+        with gzip.open(self.snapshot_path(name), "rt") as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+
+    # Backup
+
+    def backup(self, name, sources, exclude=(), replace=None):
+        """
+        Store the sources, files or directories, as snapshot name. Files
+        with the size, mtime, ctime and inode of the last backup are not
+        read again. Paths in exclude are left out. replace maps paths to
+        files to store in their place, such as database snapshots. Returns
+        a dict with the numbers of files and bytes, the files and bytes
+        read, the new chunks and the bytes they took, and the seconds it
+        took.
+        """
+        if os.path.exists(self.snapshot_path(name)):
+            raise ValueError(f"snapshot {name} already exists")
+        started = time.monotonic()
+        self.known = {row[0] for row in
+                      self.db.execute("SELECT hash FROM chunks")}
+        self.cache = {row[0]: (tuple(row[1:5]), row[5]) for row in
+                      self.db.execute("SELECT path, size, mtime_ns, ctime_ns,"
+                                      " inode, chunks FROM files")}
+        self.replace = replace or {}
+        self.new_chunks = []
+        self.new_files = []
+        self.stats = {"files": 0, "bytes": 0, "files_read": 0,
+                      "bytes_read": 0, "new_chunks": 0, "bytes_stored": 0,
+                      "vanished": 0}
+        self.pack = max(self.pack_ids(), default=0) + 1
+        self.pack_file = open(self.pack_path(self.pack), "wb")
+        tmp_path = self.snapshot_path(name) + ".tmp"
+        try:
+            with gzip.open(tmp_path, "wt", compresslevel=6) as manifest, \
+                    ThreadPoolExecutor(max_workers=self.workers) as pool:
+                manifest.write(json.dumps({"snapshot": name,
+                                           "time": time.time(),
+                                           "sources": list(sources)}) + "\n")
+                pending = deque()
+                for source in sources:
+                    for path, st in walk(source):
+                        if path in exclude:
+                            continue
+                        pending.append(pool.submit(self.backup_entry, path, st))
+                        # Enough queued to keep the workers busy
+                        while len(pending) > self.workers * 16:
+                            self.write_entry(manifest, pending.popleft())
+                while pending:
+                    self.write_entry(manifest, pending.popleft())
+            self.close_pack()
+            with self.db:
+                self.db.executemany("INSERT OR IGNORE INTO chunks"
+                                    " VALUES (?, ?, ?, ?, ?)", self.new_chunks)
+                self.db.execute("DELETE FROM files")
+                self.db.executemany("INSERT OR REPLACE INTO files"
+                                    " VALUES (?, ?, ?, ?, ?, ?)",
+                                    self.new_files)
+            fsync_path(tmp_path)
+            os.replace(tmp_path, self.snapshot_path(name))
+        except BaseException:
+            # What was written is not in the index, gc removes the pack
+            self.close_pack()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.stats["seconds"] = time.monotonic() - started
+        return self.stats
+
+    def write_entry(self, manifest, future):
+        entry = future.result()
+        if entry is not None:
+            manifest.write(json.dumps(entry) + "\n")
+
+    def backup_entry(self, path, st):
+        """ The manifest entry of path, storing its chunks if it changed. """
+        entry = {"path": path.lstrip("/"), "mode": stat.S_IMODE(st.st_mode),
+                 "uid": st.st_uid, "gid": st.st_gid,
+                 "mtime_ns": st.st_mtime_ns}
+        if stat.S_ISDIR(st.st_mode):
+            entry["type"] = "d"
+            return entry
+        if stat.S_ISLNK(st.st_mode):
+            entry["type"] = "l"
+            try:
+                entry["target"] = os.readlink(path)
+            except FileNotFoundError:
+                return self.vanished(path)
+            return entry
+
+        entry["type"] = "f"
+        key = (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+        cached = self.cache.get(path)
+        digests = None
+        size = st.st_size
+        if (cached is not None and cached[0] == key
+                and path not in self.replace):
+            digests = [cached[1][i:i + 32]
+                       for i in range(0, len(cached[1]), 32)]
+            if not all(d in self.known for d in digests):
+                digests = None
+        if digests is None:
+            digests = []
+            size = 0
+            try:
+                with open(self.replace.get(path, path), "rb") as f:
+                    for chunk in chunks(f):
+                        digest = hashlib.sha256(chunk).digest()
+                        digests.append(digest)
+                        size += len(chunk)
+                        self.store(digest, chunk)
+                    after = os.fstat(f.fileno())
+            except FileNotFoundError:
+                return self.vanished(path)
+            with self.lock:
+                self.stats["files_read"] += 1
+                self.stats["bytes_read"] += size
+            changed = (size, after.st_mtime_ns, after.st_ctime_ns) != key[:3]
+            if changed or path in self.replace:
+                # Snapshots, and files that changed while they were read, are
+                # read again next time
+                key = (-1,) + key[1:]
+        entry["size"] = size
+        entry["chunks"] = [d.hex() for d in digests]
+        with self.lock:
+            self.stats["files"] += 1
+            self.stats["bytes"] += size
+            self.new_files.append((path, *key, b"".join(digests)))
+        return entry
+
+    def vanished(self, path):
+        print(f"{path} vanished during the backup")
+        with self.lock:
+            self.stats["vanished"] += 1
+        return None
+
+    def store(self, digest, chunk):
+        """ Append chunk to the pack, unless the repository has it. """
+        with self.lock:
+            if digest in self.known:
+                return
+            self.known.add(digest)
+        blob = encode(chunk)
+        with self.lock:
+            offset = self.pack_file.tell()
+            self.pack_file.write(blob)
+            self.new_chunks.append((digest, self.pack, offset, len(blob),
+                                    len(chunk)))
+            self.stats["new_chunks"] += 1
+            self.stats["bytes_stored"] += len(blob)
+            if offset + len(blob) >= self.pack_size:
+                self.close_pack()
+                self.pack += 1
+                self.pack_file = open(self.pack_path(self.pack), "wb")
+
+    def close_pack(self):
+        if self.pack_file.closed:
+            return
+        self.pack_file.flush()
+        os.fsync(self.pack_file.fileno())
+        self.pack_file.close()
+        if os.path.getsize(self.pack_path(self.pack)) == 0:
+            os.remove(self.pack_path(self.pack))
+
+    # Reading
+
+    def read_chunk(self, digest):
+        """ The data of the chunk digest, checked against its hash. """
+        row = self.db.execute("SELECT pack, offset, length FROM chunks"
+                              " WHERE hash = ?", (digest,)).fetchone()
+        if row is None:
+            raise KeyError(f"chunk {digest.hex()} is missing")
+        pack, offset, length = row
+        if pack not in self.packs:
+            self.packs[pack] = open(self.pack_path(pack), "rb")
+        f = self.packs[pack]
+        f.seek(offset)
+        chunk = decode(f.read(length))
+        if hashlib.sha256(chunk).digest() != digest:
+            raise ValueError(f"chunk {digest.hex()} in pack {pack} is "
+                             "damaged")
+        return chunk
+
+    def restore(self, name, target, paths=()):
+        """
+        Write the files of snapshot name below target, with their
+        permissions and times, and their owners when run as root. With
+        paths, only what is at or below those paths in the snapshot.
+        Returns the number of files restored.
+        """
+        prefixes = [p.strip("/") for p in paths]
+        directories = []
+        restored = 0
+        for entry in self.entries(name):
+            path = entry["path"]
+            if prefixes and not any(path == p or path.startswith(p + "/")
+                                    for p in prefixes):
+                continue
+            dest = os.path.join(target, path)
+            if entry["type"] == "d":
+                os.makedirs(dest, exist_ok=True)
+                directories.append((dest, entry))
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.lexists(dest):
+                os.remove(dest)
+            if entry["type"] == "l":
+                os.symlink(entry["target"], dest)
+            else:
+                with open(dest, "wb") as f:
+                    for digest in entry["chunks"]:
+                        f.write(self.read_chunk(bytes.fromhex(digest)))
+                restored += 1
+            set_attributes(dest, entry)
+        # After their contents, which change their mtimes
+        for dest, entry in reversed(directories):
+            set_attributes(dest, entry)
+        return restored
+
+    # Maintenance
+
+    def prune(self, keep):
+        """
+        Delete all but the newest keep snapshots and collect the chunks
+        only they used. Returns the names deleted and the gc stats.
+        """
+        snapshots = self.snapshots()
+        deleted = [name for name, _ in snapshots[:max(len(snapshots) - keep,
+                                                       0)]]
+        for name in deleted:
+            os.remove(self.snapshot_path(name))
+        return deleted, self.gc()
+
+    def gc(self):
+        """
+        Remove chunks no snapshot uses. Packs with nothing left in them are
+        deleted, and packs less than REPACK_BELOW used are rewritten with
+        just their used chunks. Returns a dict with the chunks removed and
+        the bytes freed.
+        """
+        used = set()
+        for name, _ in self.snapshots():
+            for entry in self.entries(name):
+                used.update(bytes.fromhex(d) for d in entry.get("chunks", ()))
+        unused = [row[0] for row in self.db.execute("SELECT hash FROM chunks")
+                  if row[0] not in used]
+        with self.db:
+            self.db.executemany("DELETE FROM chunks WHERE hash = ?",
+                                ((d,) for d in unused))
+            stale = [row[0] for row in
+                     self.db.execute("SELECT path, chunks FROM files")
+                     if any(row[1][i:i + 32] not in used
+                            for i in range(0, len(row[1]), 32))]
+            self.db.executemany("DELETE FROM files WHERE path = ?",
+                                ((p,) for p in stale))
+
+        live = dict(self.db.execute("SELECT pack, SUM(length) FROM chunks"
+                                    " GROUP BY pack"))
+        freed = 0
+        for pack in self.pack_ids():
+            size = os.path.getsize(self.pack_path(pack))
+            if pack not in live:
+                self.drop_pack(pack)
+                freed += size
+            elif live[pack] < size * REPACK_BELOW:
+                self.repack(pack)
+                freed += size - live[pack]
+        return {"chunks_removed": len(unused), "bytes_freed": freed}
+
+    def drop_pack(self, pack):
+        if pack in self.packs:
+            self.packs.pop(pack).close()
+        os.remove(self.pack_path(pack))
+
+    def repack(self, pack):
+        """ Move the used chunks of pack to a new pack and delete it. """
+        new_pack = max(self.pack_ids()) + 1
+        rows = self.db.execute("SELECT hash, offset, length FROM chunks"
+                               " WHERE pack = ? ORDER BY offset",
+                               (pack,)).fetchall()
+        moved = []
+        with open(self.pack_path(pack), "rb") as old, \
+                open(self.pack_path(new_pack), "wb") as new:
+            for digest, offset, length in rows:
+                old.seek(offset)
+                moved.append((new_pack, new.tell(), digest))
+                new.write(old.read(length))
+            new.flush()
+            os.fsync(new.fileno())
+        with self.db:
+            self.db.executemany("UPDATE chunks SET pack = ?, offset = ?"
+                                " WHERE hash = ?", moved)
+        self.drop_pack(pack)
+
+    def check(self, read_data=True):
+        """
+        Check that every chunk the snapshots use is in the index and, with
+        read_data, that every chunk reads back with the right hash. Returns
+        the problems found.
+        """
+        problems = []
+        indexed = {row[0] for row in self.db.execute("SELECT hash FROM chunks")}
+        for name, _ in self.snapshots():
+            for entry in self.entries(name):
+                for d in entry.get("chunks", ()):
+                    if bytes.fromhex(d) not in indexed:
+                        problems.append(f"{name}: {entry['path']} needs "
+                                        f"missing chunk {d}")
+        if read_data:
+            for digest in indexed:
+                try:
+                    self.read_chunk(digest)
+                except (KeyError, ValueError, OSError, zlib.error) as e:
+                    problems.append(str(e))
+        return problems
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def set_attributes(path, entry):
+    if os.geteuid() == 0:
+        os.chown(path, entry["uid"], entry["gid"], follow_symlinks=False)
+    if entry["type"] != "l":
+        os.chmod(path, entry["mode"])
+    os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]),
+             follow_symlinks=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m homelab.dedup")
+    parser.add_argument("repository")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the snapshots")
+    restore_parser = commands.add_parser(
+        "restore", help="Restore a snapshot below a directory")
+    restore_parser.add_argument("snapshot")
+    restore_parser.add_argument("target")
+    restore_parser.add_argument("paths", nargs="*", metavar="PATH",
+                                help="Only restore these paths")
+    check_parser = commands.add_parser(
+        "check", help="Check that every snapshot can be restored")
+    check_parser.add_argument("--no-read", action="store_false",
+                              dest="read_data",
+                              help="Only check the index, not the packs")
+    prune_parser = commands.add_parser(
+        "prune", help="Keep the newest snapshots and free the space of the rest")
+    prune_parser.add_argument("--keep", type=int, required=True)
+    args = parser.parse_args()
+
+    try:
+        with Repository(args.repository) as repo:
+            if args.command == "list":
+                for name, created in repo.snapshots():
+                    created = time.strftime("%Y-%m-%d %H:%M",
+                                            time.localtime(created))
+                    print(f"{name}  {created}")
+            elif args.command == "restore":
+                count = repo.restore(args.snapshot, args.target, args.paths)
+                print(f"Restored {count} files to {args.target}")
+            elif args.command == "check":
+                problems = repo.check(args.read_data)
+                for problem in problems:
+                    print(problem)
+                print(f"{len(problems)} problems found")
+                sys.exit(1 if problems else 0)
+            elif args.command == "prune":
+                deleted, stats = repo.prune(args.keep)
+                print(f"Deleted {', '.join(deleted) or 'no snapshots'}, "
+                      f"freed {stats['bytes_freed']} bytes")
+    except (OSError, ValueError, RuntimeError, KeyError) as e:
+        print(f"homelab.dedup: {e}", file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
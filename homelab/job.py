@@ -0,0 +1,123 @@
+"""
+A job is one run of a script: timed phases, the fields to report, and the
+notifiers and metrics that get the result at the end.
+
+    with Job("apt-upgrade", notifiers=[DiscordNotifier(url)]) as job:
+        with job.phase("update"):
+            job.run(["apt-get", "update"])
+        job.field("Package Updates", count)
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from homelab.process import CommandFailed, run_command
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.duration = None
+        self.success = None
+        self.error = None
+
+
+class Job:
+    """
+    Collects what happened during a run and reports it when the with block
+    ends. An exception leaving the block marks the job as failed, is
+    reported and then raised again, so the script still exits non-zero.
+
+    title defaults to the hostname. description, thumbnail and color are
+    used by notifiers that show them. notify_success=False only reports
+    failures, for jobs that usually have nothing to say.
+    """
+    def __init__(self, name, title=None, notifiers=(), metrics=(),
+                 description=None, thumbnail=None, color=None,
+                 notify_success=True):
+        self.name = name
+        self.title = title or os.uname()[1]
+        self.description = description
+        self.thumbnail = thumbnail
+        self.color = color
+        self.notifiers = list(notifiers)
+        self.metrics = list(metrics)
+        self.notify_success = notify_success
+        self.fields = []
+        self.phases = []
+        self.start_time = None
+        self.end_time = None
+        self.success = None
+        self.error = None
+        # Where the output of commands goes, the runner points it to a file
+        self.log_file = sys.stdout
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self):
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+    def field(self, name, value, inline=True):
+        """ Add a value to report, e.g. the number of packages upgraded. """
+        self.fields.append((name, value, inline))
+
+    @contextmanager
+    def phase(self, name):
+        """ Time the block as a phase of the job. """
+        phase = Phase(name)
+        with self._lock:
+            self.phases.append(phase)
+        try:
+            yield phase
+        except BaseException as e:
+            phase.success = False
+            phase.error = str(e)
+            raise
+        else:
+            phase.success = True
+        finally:
+            phase.duration = time.time() - phase.start_time
+
+    def run(self, args, **kwargs):
+        """
+        Run a command with run_command, its output going to the job's
+        log_file. Returns the CommandResult.
+        """
+        kwargs.setdefault("log_file", self.log_file)
+        return run_command(args, **kwargs)
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_time = time.time()
+        self.success = exc_type is None
+        if isinstance(exc, CommandFailed):
+            self.error = f"{exc}\n{exc.tail}"
+        elif exc is not None:
+            self.error = "".join(
+                traceback.format_exception_only(exc_type, exc)).strip()
+        self.report()
+        return False
+
+    def report(self):
+        """ Hand the result to the metrics and notifiers. """
+        for metrics in self.metrics:
+            try:
+                metrics.write(self)
+            except OSError as e:
+                print(f"Cannot write metrics for {self.name}: {e}")
+        if self.success and not self.notify_success:
+            return
+        for notifier in self.notifiers:
+            try:
+                notifier.notify(self)
+            except Exception as e:
+                print(f"{type(notifier).__name__} failed: {e}")
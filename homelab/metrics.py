@@ -0,0 +1,96 @@
+"""
+Metrics sinks get a finished Job and record it for monitoring.
+"""
+import json
+import os
+import re
+
+
+def write_atomic(path, text):
+    """ Replace path with text, so readers never see a partial file. """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def prometheus_text(metrics):
+    """
+    The node_exporter textfile format of metrics, (name, help_text,
+    samples) tuples where samples are (labels, value) pairs. Samples
+    without a value are left out.
+    """
+    lines = []
+    for name, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            if label_text:
+                lines.append(f"{name}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class JsonMetrics:
+    """ Write the result of the last run of each job to <directory>/<job>.json. """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, job):
+        report = {
+            "job": job.name,
+            "success": job.success,
+            "start_time": job.start_time,
+            "end_time": job.end_time,
+            "duration": job.duration,
+            "phases": {
+                phase.name: {"duration": phase.duration,
+                             "success": phase.success}
+                for phase in job.phases
+            },
+            "fields": {name: value for name, value, _ in job.fields},
+            "error": job.error,
+        }
+        write_atomic(os.path.join(self.directory, f"{job.name}.json"),
+                     json.dumps(report, indent=2, default=str) + "\n")
+
+
+class PrometheusMetrics:
+    """
+    Write the result of the last run of each job for the node_exporter
+    textfile collector, to <directory>/homelab_<job>.prom. Numeric fields
+    are exported as homelab_job_field{field="..."}.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, job):
+        metrics = []
+
+        def metric(name, help_text, samples):
+            metrics.append((f"homelab_job_{name}", help_text,
+                            [(dict(job=job.name, **labels), value)
+                             for labels, value in samples]))
+
+        metric("success", "Whether the last run succeeded.",
+               [({}, int(bool(job.success)))])
+        metric("last_run_timestamp_seconds", "End time of the last run.",
+               [({}, job.end_time)])
+        metric("duration_seconds", "Duration of the last run.",
+               [({}, job.duration)])
+        metric("phase_duration_seconds", "Duration of each phase.",
+               [({"phase": phase.name}, phase.duration)
+                for phase in job.phases])
+        metric("field", "Numeric values reported by the job.",
+               [({"field": re.sub(r"\W+", "_", name).strip("_").lower()},
+                 value)
+                for name, value, _ in job.fields
+                if isinstance(value, (int, float))
+                and not isinstance(value, bool)])
+        name = re.sub(r"\W+", "_", job.name)
+        write_atomic(os.path.join(self.directory, f"homelab_{name}.prom"),
+                     prometheus_text(metrics))
@@ -0,0 +1,408 @@
+"""
+Notifiers get a finished Job and tell someone about it.
+
+Discord messages go through an on-disk outbox that a background thread
+drains, so a slow or failing webhook neither blocks a job nor loses the
+message: what is not sent by the time the script exits is sent by the next
+one.
+"""
+import abc
+import atexit
+import http.client
+import itertools
+import json
+import os
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+SUCCESS_COLOR = 12868102
+FAILURE_COLOR = 15158332
+
+OUTBOX_DIR = os.environ.get(
+    "HOMELAB_OUTBOX", os.path.expanduser("~/.cache/homelab/outbox"))
+# Discord's limits for a single message
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+# Seconds after which a .tmp file in the outbox is left over from a crash
+STALE_TMP_AGE = 300
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} hours {minutes} minutes"
+    return f"{minutes} minutes {seconds} seconds"
+
+
+class Notifier(abc.ABC):
+    """ Something a Job tells about its result when it finishes. """
+    @abc.abstractmethod
+    def notify(self, job):
+        pass
+
+
+class PrintNotifier(Notifier):
+    """ Print the result, for runs from a terminal. """
+    def notify(self, job):
+        status = "done" if job.success else "FAILED"
+        print(f"{job.name} {status} in {format_duration(job.duration)}")
+        for name, value, _ in job.fields:
+            print(f"  {name}: {value}")
+        if job.error:
+            print(job.error)
+
+
+class DiscordNotifier(Notifier):
+    """
+    Post the result as an embed to a Discord webhook, in the style all the
+    scripts here use: the job's fields, the duration and the date on
+    success, the fields so far and the error on failure.
+    """
+    def __init__(self, webhook_url, timezone="America/New_York"):
+        self.webhook_url = webhook_url
+        self.timezone = timezone
+
+    def embed(self, job):
+        from zoneinfo import ZoneInfo
+        now = datetime.now(ZoneInfo(self.timezone))
+        if job.success:
+            embed = {
+                "title": job.title,
+                "color": job.color or SUCCESS_COLOR,
+                "fields": [
+                    {"name": name, "value": str(value), "inline": inline}
+                    for name, value, inline in job.fields
+                ] + [
+                    {
+                        "name": "Duration",
+                        "value": format_duration(job.duration),
+                    },
+                    {
+                        "name": "Date and Time",
+                        "value": now.strftime("%m/%d/%y %I:%M %p"),
+                    },
+                ],
+            }
+            if job.description:
+                embed["description"] = job.description
+        else:
+            embed = {
+                "title": f"{job.title} failed",
+                "description": f"```{(job.error or '')[-2000:]}```",
+                "color": FAILURE_COLOR,
+                "fields": [
+                    {"name": name, "value": str(value), "inline": inline}
+                    for name, value, inline in job.fields
+                ] + [
+                    {
+                        "name": "Date and Time",
+                        "value": now.strftime("%m/%d/%y %I:%M %p"),
+                    },
+                ],
+            }
+        if job.thumbnail:
+            embed["thumbnail"] = {"url": job.thumbnail}
+        return embed
+
+    def notify(self, job):
+        send_discord(self.webhook_url, [self.embed(job)])
+
+
+class WebhookSession:
+    """
+    Keeps one HTTP connection per host open, so a batch of messages does
+    not do a TCP and TLS handshake for each.
+    """
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.connections = {}
+
+    def connection(self, scheme, host):
+        key = (scheme, host)
+        if key not in self.connections:
+            cls = (http.client.HTTPSConnection if scheme == "https"
+                   else http.client.HTTPConnection)
+            self.connections[key] = cls(host, timeout=self.timeout)
+        return self.connections[key]
+
+    def post(self, url, payload):
+        """ POST payload as JSON, returns (status, headers, body). """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json",
+                   "User-Agent": "homelab-scripts"}
+        for retry in (True, False):
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("POST", path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError):
+                # The server closed the kept-alive connection, reconnect once
+                self.close(parts.scheme, parts.netloc)
+                if not retry:
+                    raise
+                continue
+            except (http.client.HTTPException, OSError):
+                self.close(parts.scheme, parts.netloc)
+                raise
+            if response.will_close:
+                self.close(parts.scheme, parts.netloc)
+            return response.status, response.headers, data
+
+    def close(self, scheme=None, host=None):
+        for key in list(self.connections):
+            if scheme is None or key == (scheme, host):
+                self.connections.pop(key).close()
+
+
+def embed_chars(embed):
+    """ The characters Discord counts towards MAX_EMBED_CHARS. """
+    return (len(embed.get("title", "")) + len(embed.get("description", ""))
+            + sum(len(f["name"]) + len(str(f["value"]))
+                  for f in embed.get("fields", []))
+            + len(embed.get("footer", {}).get("text", ""))
+            + len(embed.get("author", {}).get("name", "")))
+
+
+def batches(messages):
+    """
+    Coalesce queued messages, (path, url, embed) tuples, into batches for
+    the same webhook of up to MAX_EMBEDS embeds and MAX_EMBED_CHARS.
+    """
+    batch = []
+    chars = 0
+    for message in messages:
+        size = embed_chars(message[2])
+        if batch and (message[1] != batch[0][1] or len(batch) == MAX_EMBEDS
+                      or chars + size > MAX_EMBED_CHARS):
+            yield batch
+            batch, chars = [], 0
+        batch.append(message)
+        chars += size
+    if batch:
+        yield batch
+
+
+class DiscordDispatcher:
+    """
+    Sends Discord messages from an outbox directory in a background thread.
+
+    send() writes each embed to a file in outbox and returns. The thread
+    waits linger seconds for more to arrive, then posts them in batches over
+    a kept-alive connection. It waits as long as Discord asks on 429 and
+    backs off on errors and rate limits. Messages that still fail after
+    max_attempts stay in the outbox for the next run. Messages Discord
+    rejects are moved to outbox/failed. Each process sends the messages it
+    queued itself and those left by processes that are gone, claiming files
+    by renaming them, so nothing is sent twice and no process waits on
+    another's messages.
+    """
+    def __init__(self, outbox=OUTBOX_DIR, timeout=10, linger=0.5,
+                 max_attempts=5):
+        self.outbox = outbox
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self.session = WebhookSession(timeout)
+        self.counter = itertools.count()
+        self.unsent = set()
+        self.done = threading.Condition()
+        self.wake = threading.Event()
+        # The messages hold the webhook URLs, which are credentials
+        for directory in (outbox, os.path.join(outbox, "failed")):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            os.chmod(directory, 0o700)
+        self.recover()
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def recover(self):
+        """
+        Release files claimed by processes that are gone, and remove the
+        half-written ones that crashes left behind.
+        """
+        for name in os.listdir(self.outbox):
+            path = os.path.join(self.outbox, name)
+            if name.endswith(".json.tmp"):
+                try:
+                    if time.time() - os.stat(path).st_mtime > STALE_TMP_AGE:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            base, _, pid = name.rpartition(".json.")
+            if base and pid.isdigit() and not process_alive(int(pid)):
+                try:
+                    os.replace(path, os.path.join(self.outbox, base + ".json"))
+                except FileNotFoundError:
+                    pass
+        if any(name.endswith(".json") for name in os.listdir(self.outbox)):
+            self.wake.set()
+
+    def send(self, webhook_url, embeds):
+        """ Queue embeds for webhook_url. """
+        for embed in embeds:
+            name = (f"{time.time_ns()}-{os.getpid()}-"
+                    f"{next(self.counter)}.json")
+            path = os.path.join(self.outbox, name)
+            fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"url": webhook_url, "embed": embed}, f)
+            with self.done:
+                self.unsent.add(name)
+            os.replace(path + ".tmp", path)
+        self.wake.set()
+
+    def flush(self, timeout=30):
+        """
+        Wait up to timeout seconds for the messages queued by this process
+        to be sent. Returns True if they were.
+        """
+        with self.done:
+            return self.done.wait_for(lambda: not self.unsent, timeout)
+
+    def finished(self, names):
+        with self.done:
+            self.unsent.difference_update(names)
+            self.done.notify_all()
+
+    def claim(self):
+        """
+        Rename the files queued by this process or by processes that are
+        gone to this process, returns the messages.
+        """
+        messages = []
+        pid = os.getpid()
+        suffix = f".{pid}"
+        alive = {pid: True}
+        for name in sorted(os.listdir(self.outbox)):
+            if not name.endswith(".json"):
+                continue
+            owner = queued_by(name)
+            if owner is not None:
+                if owner not in alive:
+                    alive[owner] = process_alive(owner)
+                if owner != pid and alive[owner]:
+                    continue  # Its own process sends it
+            path = os.path.join(self.outbox, name)
+            try:
+                os.rename(path, path + suffix)
+                with open(path + suffix) as f:
+                    message = json.load(f)
+            except FileNotFoundError:
+                continue  # Claimed by another process
+            except ValueError:
+                os.replace(path + suffix,
+                           os.path.join(self.outbox, "failed", name))
+                self.finished([name])
+                continue
+            messages.append((path, message["url"], message["embed"]))
+        return messages
+
+    def drain(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.linger)
+            self.wake.clear()
+            messages = self.claim()
+            for batch in batches(messages):
+                self.post(batch)
+
+    def post(self, batch):
+        suffix = f".{os.getpid()}"
+        names = [os.path.basename(path) for path, _, _ in batch]
+        attempts = 0
+        while True:
+            try:
+                status, headers, body = self.session.post(
+                    batch[0][1], {"embeds": [embed for _, _, embed in batch]})
+            except (http.client.HTTPException, OSError) as e:
+                status, headers, body, error = None, {}, b"", str(e)
+            else:
+                error = f"HTTP {status} {body[:200]!r}"
+
+            if status is not None and 200 <= status < 300:
+                for path, _, _ in batch:
+                    os.remove(path + suffix)
+                break
+            if status is not None and status != 429 and 400 <= status < 500:
+                if len(batch) > 1:
+                    # Find the message Discord does not accept
+                    for message in batch:
+                        self.post([message])
+                    return
+                print(f"Discord rejected a message, kept in failed: {error}")
+                os.replace(batch[0][0] + suffix, os.path.join(
+                    self.outbox, "failed", names[0]))
+                break
+            attempts += 1
+            if attempts >= self.max_attempts:
+                print(f"Cannot reach Discord, will retry next run: {error}")
+                for path, _, _ in batch:
+                    os.replace(path + suffix, path)
+                break
+            if status == 429:
+                time.sleep(retry_after(headers, body))
+            else:
+                time.sleep(min(2 ** attempts, 60))
+        self.finished(names)
+
+
+def queued_by(name):
+    """ The pid of the process that queued the outbox file name, or None. """
+    parts = name.split("-")
+    if len(parts) == 3 and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def retry_after(headers, body):
+    """ Seconds to wait after a 429, from the header or the JSON body. """
+    delays = [1.0]
+    try:
+        delays.append(float(headers.get("Retry-After", 0)))
+    except ValueError:
+        pass
+    try:
+        delays.append(float(json.loads(body).get("retry_after", 0)))
+    except (ValueError, AttributeError):
+        pass
+    return max(delays)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatcher():
+    """
+    The dispatcher of this process. At exit it gets up to 30 seconds to
+    send what is queued, the rest is left in the outbox.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = DiscordDispatcher()
+            atexit.register(_dispatcher.flush)
+        return _dispatcher
+
+
+def send_discord(webhook_url, embeds):
+    """ Queue embeds for webhook_url on the dispatcher of this process. """
+    dispatcher().send(webhook_url, embeds)
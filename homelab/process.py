@@ -0,0 +1,132 @@
+"""
+Running commands with their output streamed line by line instead of
+collected, so long jobs show up in their logs as they go, and as filters
+that data is streamed through.
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class CommandFailed(Exception):
+    """ A command exited with a status that was not allowed. """
+    def __init__(self, args, returncode, tail):
+        self.command = args if isinstance(args, str) else " ".join(args)
+        self.returncode = returncode
+        self.tail = tail
+        super().__init__(f"{self.command} exited with {returncode}")
+
+
+class CommandResult:
+    def __init__(self, returncode, tail, duration, timed_out=False):
+        self.returncode = returncode
+        self.tail = tail
+        self.duration = duration
+        self.timed_out = timed_out
+
+
+def run_command(args, on_line=None, log_file=None, check=True,
+                allow_returncodes=(0,), timeout=None, tail_lines=50, **popen):
+    """
+    Run args with stdout and stderr merged, handing every line to on_line
+    and writing it to log_file as it arrives. The last tail_lines lines are
+    kept for error reports. After timeout seconds the command is killed,
+    along with everything it started.
+
+    Returns a CommandResult, or raises CommandFailed if check is set and the
+    exit status is not in allow_returncodes. Other keyword arguments are
+    passed to Popen.
+    """
+    tail = deque(maxlen=tail_lines)
+    started = time.monotonic()
+    # In its own session, the command's children can be killed with it
+    p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                         text=True, errors="replace",
+                         start_new_session=bool(timeout), **popen)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        for line in p.stdout:
+            tail.append(line)
+            if log_file:
+                log_file.write(line)
+                log_file.flush()
+            if on_line:
+                on_line(line)
+        returncode = p.wait()
+    finally:
+        if timer:
+            timer.cancel()
+    result = CommandResult(returncode, "".join(tail),
+                           time.monotonic() - started, timed_out.is_set())
+    if check and returncode not in allow_returncodes:
+        raise CommandFailed(args, returncode, result.tail)
+    return result
+
+
+@contextmanager
+def pipe_through(args, output, chunk_size=1 << 20, **popen):
+    """
+    Run args as a filter between the caller and output: yield its stdin to
+    write to, while a thread copies its stdout to output in chunk_size
+    pieces. Leaving the block closes stdin and waits for the command.
+
+    Raises CommandFailed with its stderr if the command exits non-zero, and
+    whatever output.write raises. Other keyword arguments are passed to
+    Popen.
+    """
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, bufsize=chunk_size, **popen)
+    errors = []
+    stderr = []
+
+    def copy_output():
+        try:
+            for chunk in iter(lambda: p.stdout.read(chunk_size), b""):
+                output.write(chunk)
+        except BaseException as e:
+            errors.append(e)
+            # Unblock the writer, which would wait on a full pipe forever
+            p.kill()
+
+    threads = [threading.Thread(target=copy_output),
+               threading.Thread(target=lambda: stderr.append(p.stderr.read()))]
+    for thread in threads:
+        thread.start()
+    broken = False
+    try:
+        yield p.stdin
+    except BrokenPipeError:
+        # The command is gone, its exit status or the copy error says why
+        broken = True
+    finally:
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            broken = True
+        for thread in threads:
+            thread.join()
+        returncode = p.wait()
+    if errors:
+        raise errors[0]
+    if returncode != 0:
+        raise CommandFailed(args, returncode,
+                            b"".join(stderr).decode(errors="replace"))
+    if broken:
+        raise BrokenPipeError(f"{args[0]} stopped reading its input")
@@ -0,0 +1,206 @@
+"""
+Runs the jobs of a jobs.conf, several at once, each one only after the jobs
+it comes after have succeeded. This is what python3 -m homelab run uses.
+"""
+import configparser
+import os
+import re
+import shlex
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from homelab.job import Job
+from homelab.metrics import JsonMetrics, PrometheusMetrics
+from homelab.notify import DiscordNotifier, format_duration
+from homelab.process import CommandFailed
+
+DEFAULT_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "jobs.conf")
+
+
+class JobSpec:
+    """ A job section of jobs.conf. """
+    def __init__(self, name, command, after=(), timeout=None, cwd=None):
+        self.name = name
+        self.command = command
+        self.after = list(after)
+        self.timeout = timeout
+        self.cwd = cwd
+
+
+def load_jobs(path):
+    """
+    Read jobs.conf. Returns the [homelab] settings and the jobs by name, in
+    the order of the file.
+    """
+    parser = configparser.RawConfigParser()
+    if not parser.read(path):
+        raise FileNotFoundError(f"{path} not found")
+    settings = {
+        "concurrency": 2,
+        "logdir": "logs",
+        "webhook_url": "",
+        "timezone": "America/New_York",
+        "report-dir": "",
+        "prometheus-dir": "",
+    }
+    if parser.has_section("homelab"):
+        settings.update((k, v.strip()) for k, v in parser.items("homelab"))
+    settings["concurrency"] = int(settings["concurrency"])
+    # Relative paths are relative to the config file
+    base = os.path.dirname(os.path.abspath(path))
+    for key in ("logdir", "report-dir", "prometheus-dir"):
+        if settings[key]:
+            settings[key] = os.path.join(base, settings[key])
+
+    specs = {}
+    for name in parser.sections():
+        if name == "homelab":
+            continue
+        section = parser[name]
+        if not section.get("command", "").strip():
+            raise ValueError(f"job {name} has no command")
+        timeout = section.get("timeout", "").strip()
+        specs[name] = JobSpec(
+            name, section["command"].strip(),
+            re.split(r"[,\s]+", section.get("after", "").strip())
+            if section.get("after", "").strip() else [],
+            int(timeout) * 60 if timeout else None,
+            section.get("cwd", "").strip() or None)
+    for spec in specs.values():
+        for dependency in spec.after:
+            if dependency not in specs:
+                raise ValueError(f"{spec.name} comes after unknown job "
+                                 f"{dependency}")
+    return settings, specs
+
+
+def select(specs, names, with_dependencies=True):
+    """
+    The jobs to run for names ("all" for all of them) in an order where
+    every job comes after the jobs it depends on. With with_dependencies,
+    the jobs names come after are run too.
+    """
+    if "all" in names:
+        names = list(specs)
+    for name in names:
+        if name not in specs:
+            raise ValueError(f"unknown job {name}")
+    wanted = set(names)
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"jobs depend on each other in a cycle: {name}")
+        visiting.add(name)
+        for dependency in specs[name].after:
+            if with_dependencies or dependency in wanted:
+                visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def run_job(spec, settings):
+    """ Run one job, returns True if it succeeded. """
+    metrics = []
+    if settings["report-dir"]:
+        metrics.append(JsonMetrics(settings["report-dir"]))
+    if settings["prometheus-dir"]:
+        metrics.append(PrometheusMetrics(settings["prometheus-dir"]))
+    log_path = os.path.join(settings["logdir"], f"{spec.name}.log")
+    print(f"{spec.name} started, output in {log_path}")
+    try:
+        with open(log_path, "w") as log_file, \
+                Job(spec.name, metrics=metrics) as job:
+            job.log_file = log_file
+            result = job.run(shlex.split(spec.command), timeout=spec.timeout,
+                             cwd=spec.cwd, check=False)
+            if result.timed_out:
+                raise TimeoutError(f"{spec.name} timed out after "
+                                   f"{format_duration(spec.timeout)}")
+            if result.returncode != 0:
+                raise CommandFailed(spec.command, result.returncode,
+                                    result.tail)
+    except (CommandFailed, OSError) as e:
+        print(f"{spec.name} failed: {e}")
+        return False
+    print(f"{spec.name} done in {format_duration(job.duration)}")
+    return True
+
+
+def run_jobs(specs, order, settings, dry_run=False):
+    """
+    Run the jobs in order, up to the concurrency setting at once. A job
+    starts once all jobs it comes after that are part of this run have
+    succeeded, and is skipped if one of them failed or was skipped.
+    Returns the status of each job, "ok", "failed" or "skipped".
+    """
+    status = {}
+    pending = list(order)
+    running = {}
+    if not dry_run:
+        os.makedirs(settings["logdir"], exist_ok=True)
+    concurrency = max(settings["concurrency"], 1)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while pending or running:
+            for name in list(pending):
+                after = [d for d in specs[name].after if d in order]
+                if any(status.get(d) in ("failed", "skipped") for d in after):
+                    status[name] = "skipped"
+                    pending.remove(name)
+                    print(f"{name} skipped, a job it comes after did not "
+                          "succeed")
+                elif (all(status.get(d) == "ok" for d in after)
+                        and len(running) < concurrency):
+                    pending.remove(name)
+                    if dry_run:
+                        status[name] = "ok"
+                        print(f"{name}: {specs[name].command}")
+                    else:
+                        future = pool.submit(run_job, specs[name], settings)
+                        running[future] = name
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                status[running.pop(future)] = ("ok" if future.result()
+                                               else "failed")
+    return status
+
+
+def run(conf, names, with_dependencies=True, dry_run=False, concurrency=None):
+    """
+    Run the jobs names of the jobs.conf conf and send a summary to the
+    webhook_url of its [homelab] section. Returns True if all succeeded.
+    """
+    settings, specs = load_jobs(conf)
+    if concurrency:
+        settings["concurrency"] = concurrency
+    order = select(specs, names, with_dependencies)
+    if dry_run:
+        run_jobs(specs, order, settings, dry_run=True)
+        return True
+
+    notifiers = []
+    if settings["webhook_url"]:
+        notifiers.append(DiscordNotifier(settings["webhook_url"],
+                                         settings["timezone"]))
+    try:
+        with Job("homelab", notifiers=notifiers,
+                 title=f"{os.uname()[1]} jobs") as summary:
+            status = run_jobs(specs, order, settings)
+            for name in order:
+                summary.field(name, status[name])
+            failed = [name for name in order if status[name] != "ok"]
+            if failed:
+                raise RuntimeError("Not successful: " + ", ".join(
+                    f"{name} ({status[name]})" for name in failed))
+    except RuntimeError:
+        return False
+    return True
@@ -1,12 +1,15 @@
 import requests
 import os
-import json
+import sys
 from dotenv import load_dotenv
 from lxml import html
 from os import path, makedirs, stat, listdir, remove
 from datetime import datetime
 from lxml.html import fromstring
-from pytz import timezone
+
+# Notifications go through the shared homelab package in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homelab import DiscordNotifier, Job  # noqa: E402
 
 webhook_url = 'https://discord.com/api/webhooks/<embed>'
 
@@ -128,36 +131,11 @@ class PfBak:
 
 
 
-def send_discord_embed(filename, completion_time, success=True):
-    if success:
-        embed_data = {
-            "embeds": [{
-                "title": "pfSense Backup Complete",
-                "thumbnail": {
-                    "url": "https://i.imgur.com/XK0ILmE.png"
-                },
-                "fields": [{
-                    "name": "Filename",
-                    "value": filename
-                }, {
-                    "name": "Date",
-                    "value": completion_time
-                }],
-                "color": 3066993
-            }]
-        }
-    else:
-        embed_data = {
-            "embeds": [{
-                "title": "pfSense Backup failed",
-                "description": f'```{error_output}```',
-                "color": 15158332
-            }]
-        }
-    response = requests.post(webhook_url, data=json.dumps(embed_data), headers={"Content-Type": "application/json"})
-
 if __name__ == "__main__":
-    try:
+    with Job("pfsense-backup", title="pfSense Backup",
+             description="pfSense Backup Complete",
+             thumbnail="https://i.imgur.com/XK0ILmE.png", color=3066993,
+             notifiers=[DiscordNotifier(webhook_url)]) as job:
         load_dotenv()
         pfhost = os.environ.get('PFHOST')
         username = os.environ.get('USERNAME')
@@ -173,11 +151,4 @@ if __name__ == "__main__":
 
         backup = PfBak(pfhost, username, password, encrypted_pass, backup_dir, backup_data, backup_count, ssl, backup_rrd, backup_pkg)
         backup.executeProcess()
-        filename = backup.backup_name
-        eastern = timezone('US/Eastern')
-        completion_time = datetime.now(eastern).strftime("%m/%d/%Y %I:%M:%S %p %Z")
-        send_discord_embed(filename, completion_time)
-    except Exception as e:
-        error_output = str(e)
-        send_discord_embed(None, None, success=False)
-        print(f"Backup failed: {e}")
\ No newline at end of file
+        job.field("Filename", backup.backup_name, inline=False)
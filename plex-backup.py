@@ -1,9 +1,14 @@
 import os
-import subprocess
+import tarfile
+import tempfile
 from datetime import datetime, date
-import requests
 from pytz import timezone
 
+from homelab.compress import compress, compressor
+from homelab.database import SIDE_FILES, backup_database, find_databases
+from homelab.dedup import Repository
+from homelab.notify import send_discord
+
 # Discord webhook URL
 webhook_url = 'https://discord.com/api/webhooks/<embed>'
 
@@ -16,12 +21,38 @@ source_directories = [
 # Backup destination 
 backup_dir = '/path/to/backup/location'
 
-def send_discord_message(filename, success=True, error_output=None):
+# Compression: auto, zstd, xz, gzip, bzip2 or none. auto uses the fastest
+# installed tool (zstd, pigz, pbzip2, xz), threads 0 uses every core
+compression = 'auto'
+compression_level = None
+compression_threads = 0
+
+# Set to a directory to keep the backups in a deduplicating repository
+# instead of writing a full archive every run: only changed files are read
+# and only new data is stored. Restore with
+# python3 -m homelab.dedup <repository> restore <snapshot> <target>
+repository = None
+
+# Backups to keep, archives or repository snapshots
+keep_backups = 5
+
+# Back up the Plex databases from consistent copies made with SQLite's
+# online backup API instead of the live files (and their -wal and -shm),
+# which Plex writes to while they are read. The copies are made in
+# snapshot_dir, the system temp directory if None, which needs room for
+# all of them.
+snapshot_databases = True
+snapshot_dir = None
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def send_discord_message(filename, success=True, error_output=None, fields=()):
     """ Sends a Discord message. """
-    headers = {
-        "Content-Type": "application/json"
-    }
-
     if success:
         now = datetime.now(timezone('US/Eastern')).strftime(
             "%m/%d/%Y %I:%M:%S %p %Z")
@@ -41,6 +72,11 @@ def send_discord_message(filename, success=True, error_output=None):
                 "color": 12868102
             }]
         }
+        for name, value in fields:
+            embed_data["embeds"][0]["fields"].append({
+                "name": name,
+                "value": value
+            })
     else:
         embed_data = {
             "embeds": [{
@@ -50,45 +86,105 @@ def send_discord_message(filename, success=True, error_output=None):
             }]
         }
 
-    response = requests.post(webhook_url, headers=headers, json=embed_data)
-    if response.status_code != 204:
-        print(f"Failed to send Discord message: {response.text}")
+    send_discord(webhook_url, embed_data["embeds"])
 
-# Keep the most recent 5 backups
+# Keep the most recent keep_backups backups
 def clean_up_backups(save_dir):
     existing_files = os.listdir(save_dir)
 
-    filtered_files = [file for file in existing_files if file.startswith("plex-backup-") and file.endswith(".tar.gz")]
+    filtered_files = [file for file in existing_files if file.startswith("plex-backup-") and ".tar" in file and not file.endswith(".partial")]
 
     filtered_files.sort(key=lambda x: os.path.getmtime(os.path.join(save_dir, x)))
 
-    if len(filtered_files) > 5:
-        files_to_remove = filtered_files[:-5]
+    if len(filtered_files) > keep_backups:
+        files_to_remove = filtered_files[:-keep_backups]
         for file in files_to_remove:
             file_path = os.path.join(save_dir, file)
             os.remove(file_path)
 
+def snapshot_plex_databases(tmpdir):
+    """ Copy the databases below the sources into tmpdir, returns {database: copy}. """
+    if not snapshot_databases:
+        return {}
+    snapshots = {}
+    for i, database in enumerate(find_databases(source_directories)):
+        snapshot = os.path.join(tmpdir, f"{i}-{os.path.basename(database)}")
+        # Plex writes to its databases all the time, a copy in steps would
+        # start over after every write and never finish
+        result = backup_database(database, snapshot, pages_per_step=-1)
+        print(f"Copied {database}: {format_size(result['bytes'])} in {result['seconds']:.1f}s")
+        snapshots[database] = snapshot
+    return snapshots
+
+def side_files(snapshots):
+    """ The -wal, -shm and -journal files of the snapshotted databases, left out of the backup. """
+    return {database + suffix for database in snapshots for suffix in SIDE_FILES}
+
 def backup_and_send_message():
 
     today = date.today().strftime('%Y-%m-%d')
 
-    backup_filename = f"plex-backup-{today}.tar.gz"
-
-    backup_command = f"tar -czvf {os.path.join(backup_dir, backup_filename)}"
-
-    for directory in source_directories:
-        backup_command += f' "{directory}"'
+    plex_compressor = compressor(compression, compression_level, compression_threads)
+    backup_filename = f"plex-backup-{today}.tar{plex_compressor.extension}"
+    backup_path = os.path.join(backup_dir, backup_filename)
 
     try:
-        subprocess.run(backup_command, shell=True, check=True)
-        print(f"Backup created successfully: {os.path.join(backup_dir, backup_filename)}")
+        # tar is streamed into the compressor, under a temporary name until it is complete
+        with tempfile.TemporaryDirectory(dir=snapshot_dir) as tmpdir, \
+                open(backup_path + ".partial", "wb") as output, \
+                compress(output, plex_compressor) as stream, \
+                tarfile.open(fileobj=stream, mode="w|", copybufsize=1 << 20) as tar:
+            snapshots = snapshot_plex_databases(tmpdir)
+            skipped = {path.lstrip("/") for path in set(snapshots) | side_files(snapshots)}
+            for directory in source_directories:
+                tar.add(directory, filter=lambda member: None if member.name in skipped else member)
+            # The copies go in under the names and with the owner and times of the live databases
+            for database, snapshot in snapshots.items():
+                info = tar.gettarinfo(database)
+                info.size = os.path.getsize(snapshot)
+                with open(snapshot, "rb") as f:
+                    tar.addfile(info, f)
+        os.replace(backup_path + ".partial", backup_path)
+        print(f"Backup created successfully: {backup_path} ({stream.summary()})")
 
         clean_up_backups(backup_dir)
 
-        send_discord_message(backup_filename, success=True)
-    except subprocess.CalledProcessError as e:
+        send_discord_message(backup_filename, success=True,
+                             fields=[("Compression", stream.summary()),
+                                     ("Databases", f"{len(snapshots)} copied")])
+    except Exception as e:
         print(f"Error creating backup: {e}")
+        if os.path.exists(backup_path + ".partial"):
+            os.remove(backup_path + ".partial")
         send_discord_message(backup_filename, success=False, error_output=str(e))
 
+def backup_to_repository():
+
+    snapshot = f"plex-{datetime.now().strftime('%Y-%m-%d-%H%M%S')}"
+
+    try:
+        with tempfile.TemporaryDirectory(dir=snapshot_dir) as tmpdir, \
+                Repository(repository) as repo:
+            snapshots = snapshot_plex_databases(tmpdir)
+            stats = repo.backup(snapshot, source_directories,
+                                exclude=side_files(snapshots), replace=snapshots)
+            print(f"Snapshot {snapshot} created: {stats['files_read']} of "
+                  f"{stats['files']} files changed, {format_size(stats['bytes_stored'])} stored")
+            pruned, gc_stats = repo.prune(keep_backups)
+
+        send_discord_message(snapshot, success=True, fields=[
+            ("Size", format_size(stats["bytes"])),
+            ("Changed", f"{stats['files_read']} files, {format_size(stats['bytes_read'])}"),
+            ("New Data", format_size(stats["bytes_stored"])),
+            ("Freed", f"{format_size(gc_stats['bytes_freed'])} of {len(pruned)} old snapshots"),
+            ("Databases", f"{len(snapshots)} copied"),
+        ])
+    except Exception as e:
+        print(f"Error creating backup: {e}")
+        send_discord_message(snapshot, success=False, error_output=str(e))
+
 if __name__ == "__main__":
-    backup_and_send_message()
+    if repository:
+        backup_to_repository()
+    else:
+        backup_and_send_message()
@@ -1,62 +1,47 @@
 import json
-import requests
-import subprocess
 import re
+import subprocess
+import urllib.request
 
-webhook_url = 'https://discord.com/api/webhooks/<embed>'
+from homelab import DiscordNotifier, Job
 
-result = subprocess.run(["dpkg-query", "-W", "plexmediaserver"], stdout=subprocess.PIPE)
-output = result.stdout.decode("utf-8").strip()
-try:
-    current_version = re.search(r"\d+\.\d+\.\d+\.\d+-\w+", output).group()
-    print(current_version)
-except:
-    print("Couldn't determine the current version of the Plex server")
-    current_version = ""
+webhook_url = 'https://discord.com/api/webhooks/<embed>'
 
-# Get the newest version from https://plex.tv/pms/downloads/5.json
-response = requests.get("https://plex.tv/pms/downloads/5.json")
-newest_version_data = json.loads(response.text)["computer"]["Linux"]["releases"]
+# Only updates are reported, and failures
+with Job("plex-update", title="Plex Media Server",
+         description="Plex Has Been Updated",
+         thumbnail="https://i.imgur.com/HoiBO9c.png", color=15048717,
+         notifiers=[DiscordNotifier(webhook_url)],
+         notify_success=False) as job:
+    result = subprocess.run(["dpkg-query", "-W", "plexmediaserver"], stdout=subprocess.PIPE)
+    output = result.stdout.decode("utf-8").strip()
+    try:
+        current_version = re.search(r"\d+\.\d+\.\d+\.\d+-\w+", output).group()
+        print(current_version)
+    except AttributeError:
+        print("Couldn't determine the current version of the Plex server")
+        current_version = ""
 
-# Find the url for Intel/AMD 64-bit
-url = None
-for item in newest_version_data:
-    if item["build"] == "linux-x86_64":
-        url = item["url"]
-        break
+    # Get the newest version from https://plex.tv/pms/downloads/5.json
+    with urllib.request.urlopen("https://plex.tv/pms/downloads/5.json", timeout=30) as response:
+        newest_version_data = json.load(response)["computer"]["Linux"]["releases"]
 
-# Download and install the newest version if it's different from the current version
-newest_version = url.split("/")[-1].split("_")[1]
-if newest_version != current_version:
-    subprocess.run(["wget", url])
-    subprocess.run(["sudo", "dpkg", "-i", url.split("/")[-1]])
+    # Find the url for Intel/AMD 64-bit
+    url = None
+    for item in newest_version_data:
+        if item["build"] == "linux-x86_64":
+            url = item["url"]
+            break
 
-    # Send to Discord
-    headers = {
-      "Content-Type": "application/json",
-    }
-    payload = {
-        "embeds": [
-            {
-                "title": "Plex Media Server",
-                "description": "Plex Has Been Updated",
-                "thumbnail": {
-                    "url": "https://i.imgur.com/HoiBO9c.png"
-                },
-                "fields": [
-                    {
-                        "name": "Old Version",
-                        "value": current_version,
-                    },
-                    {
-                        "name": "New Version",
-                        "value": newest_version,
-                    },
-                ],
-                "color": 15048717,
-            },
-        ],
-    }
-    requests.post(webhook_url, headers=headers, json=payload)
-else:
-    print("You are running the latest version of the Plex server ({})".format(current_version))
+    # Download and install the newest version if it's different from the current version
+    newest_version = url.split("/")[-1].split("_")[1]
+    if newest_version != current_version:
+        with job.phase("download"):
+            job.run(["wget", url])
+        with job.phase("install"):
+            job.run(["sudo", "dpkg", "-i", url.split("/")[-1]])
+        job.field("Old Version", current_version, inline=False)
+        job.field("New Version", newest_version, inline=False)
+        job.notify_success = True
+    else:
+        print("You are running the latest version of the Plex server ({})".format(current_version))
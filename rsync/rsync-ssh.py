@@ -1,11 +1,10 @@
-import json
 import os
-import requests
-import re
 import time
-import subprocess
-from datetime import datetime
-import pytz
+
+from rsynclib import (RESUME_MODES, SSH_PROFILES, FileManifest, SSHMaster,
+                      Throttle, apply_compression, median_rate, plan_jobs,
+                      record_history, remote_host, run_rsync_jobs,
+                      send_discord)
 
 start_time = time.time()
 
@@ -14,95 +13,98 @@ target_dir = "<user>@<IP-ADDRESS>:/path/to/drive"
 private_key = "/home/<user>/.ssh/id_rsa"
 webhook_url = 'https://discord.com/api/webhooks/<embed>'
 hostname = os.uname()[1]
-source_dirs_string = " ".join(source_dirs)
 
-with open("rsync-ssh.log", "w") as log_file:
-    result = subprocess.run(
-        f'rsync -rltvz -a --no-links --no-specials --no-devices --delete --stats --info=skip0 --verbose -e "ssh -i {private_key}" {source_dirs_string} {target_dir}',
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    output = result.stdout.decode()
-    log_file.write(output)
+# Number of rsync processes to run at once. With more than 1, every source
+# dir gets its own rsync, and the dirs in split_dirs one per subdirectory
+workers = 1
+split_dirs = []
 
-match = re.search(
-    r"Number of files: ([\d,]+).*Number of created files: ([\d,]+).*Number of deleted files: ([\d,]+).*Number of regular files transferred: ([\d,]+).*",
-    output, re.DOTALL)
-if match:
-    synced = match.group(1)
-    created = match.group(2)
-    deleted = match.group(3)
-    transferred = match.group(4)
+# rsync compression: "auto" decides per job from a sample of the source
+# files, or "none", "zlib" or "zstd", optionally with a level as in "zstd:3"
+compression = "auto"
 
-else:
-    synced = 0
-    created = 0
-    deleted = 0
-    transferred = 0
+# Keep a manifest of the source files in this SQLite database and only hand
+# the paths that changed to rsync, with a full sync every full_every days.
+# "" lets rsync walk the whole trees on every run
+manifest_db = ""
+full_every = 7
 
-print(synced, created, deleted, transferred)
+# Throttling, so backups do not get in the way of Plex or snapraid.
+# bwlimit_schedule holds ("HH:MM", "HH:MM", limit) times of day and the
+# rsync --bwlimit for them, e.g. [("07:00", "23:00", "20m")]
+bwlimit_schedule = []
+# Priority of rsync, None to leave it alone. ionice class 3 is idle
+nice = 10
+ionice_class = 3
+# Pause rsync while other I/O keeps one of these disks more than
+# pause_above % busy, until it is below resume_below %. e.g. ["sda", "sdb"]
+busy_disks = []
+pause_above = 80
+resume_below = 50
 
-# Check for error code 23, 24, and 25 and set returncode to 0 if found
-if result.returncode in [23, 24, 25]:
-    result.returncode = 0
+# Cipher profile for the ssh connection, one of rsynclib.SSH_PROFILES
+ssh_profile = "default"
+# How interrupted transfers are picked up again, one of rsynclib.RESUME_MODES:
+# "partial" keeps partly sent files in .rsync-partial, "inplace" writes into
+# the target file directly (no extra space, but the file is incomplete
+# until the transfer is), "" starts large files over
+resume = "partial"
+# Tries after a dropped connection or timeout, and the seconds between them
+retries = 3
+retry_delay = 60
+# Give up on a connection that has not moved any data for this many seconds.
+# The remote rsync counts the time rsync is paused for busy_disks as well, so
+# pauses are cut short after half of it to let some data through
+io_timeout = 300
 
-if result.returncode == 0:
-    duration_seconds = time.time() - start_time
-    duration_minutes, duration_seconds = divmod(duration_seconds, 60)
-    duration_seconds = round(duration_seconds, 0)
+# Shell commands to run on the target host before and after the transfer
+pre_commands = []
+post_commands = []
 
+log_file_path = "rsync-ssh.log"
+# SQLite database every run is recorded in, "" to keep no history
+history_db = "rsync-ssh-history.db"
+jobs = plan_jobs(source_dirs, target_dir, split_dirs, split=workers > 1)
+apply_compression(jobs, compression)
 
-    tz = pytz.timezone("America/New_York")
-    time_ny = datetime.now(tz).strftime("%I:%M %p")
-    date_ny = datetime.now(tz).strftime("%m/%d/%y")
-    embed = {
-        'title': hostname,
-        "thumbnail": {
-            "url": "https://i.imgur.com/dFqM7CG.png"
-        },
-        'fields': [
-            {
-                'name': 'Sync',
-                'value': synced,
-                'inline': True
-            },
-            {
-                'name': 'Transfer',
-                'value': transferred,
-                'inline': True
-            },
-            {
-                'name': 'Delete',
-                'value': deleted,
-                'inline': True
-            },
-            {
-                'name': 'Duration',
-                'value': f'{int(duration_minutes)} minutes {int(duration_seconds)} seconds',
-            },
-            {
-                'name': 'Date and Time',
-                'value': f'{date_ny} {time_ny}',
-            },
-        ],
-        'color': 12868102
-    }
+# All rsyncs and remote commands share one ssh connection
+try:
+    with SSHMaster(remote_host(target_dir), private_key,
+                   SSH_PROFILES[ssh_profile]) as ssh:
+        for command in pre_commands:
+            result = ssh.run(command)
+            if result.returncode != 0:
+                raise RuntimeError(f"{command} failed: {result.stderr.strip()}")
+        rsync_args = ["rsync", "-rltv", "-a", "--no-links", "--no-specials",
+                      "--no-devices", "--delete", "--stats", "--info=skip0",
+                      "--verbose", f"--timeout={io_timeout}", "-e", ssh.rsh
+                      ] + RESUME_MODES[resume]
+        with FileManifest(manifest_db, full_every) as manifest, \
+                Throttle(bwlimit_schedule, nice, ionice_class, busy_disks,
+                         pause_above, resume_below,
+                         max_pause=io_timeout / 2 if io_timeout else None
+                         ) as throttle:
+            returncode, stats, tail, reports = run_rsync_jobs(
+                rsync_args, manifest.plan(jobs), log_file_path, "w",
+                workers=workers, throttle=throttle, retries=retries,
+                retry_delay=retry_delay)
+            # 23 means some files were not sent, they must be looked at again
+            if returncode in (0, 24):
+                manifest.save()
+        for command in post_commands:
+            result = ssh.run(command)
+            if result.returncode != 0 and returncode == 0:
+                returncode, tail = 1, f"{command} failed: {result.stderr.strip()}"
+except (ConnectionError, RuntimeError) as e:
+    returncode, stats, tail, reports = 255, None, str(e), []
 else:
-    with open(log_file_path, "r") as file:
-        error_output = file.read()
-        error_output = error_output[-2000:]
-        embed = {
-            'title': f'{hostname} rsync failed',
-            'description': f'```{error_output}```',
-            'color': 15158332,
-            'fields': [
-                {
-                    'name': 'Error Code',
-                    'value': result.returncode,
-                    'inline': True
-                }
-            ]
-        }
+    print(stats["synced"], stats["created"], stats["deleted"], stats["transferred"])
+
+usual_rate = None
+if history_db:
+    run_id = record_history(history_db, hostname, target_dir, start_time,
+                            returncode, stats, reports)
+    usual_rate = median_rate(history_db, hostname, target_dir, run_id)
 
-requests.post(webhook_url, json={'embeds': [embed]})
\ No newline at end of file
+send_discord(webhook_url, hostname, returncode, stats, start_time, tail,
+             reports, usual_rate)
@@ -1,115 +1,73 @@
-import json
 import os
-import requests
-import re
 import time
-import subprocess
-from datetime import datetime
-import pytz
+
+from rsynclib import (FileManifest, Throttle, apply_compression,
+                      median_rate, plan_jobs, record_history, run_rsync_jobs,
+                      send_discord)
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 log_file_path = os.path.join(script_dir, "rsync.log")
+# SQLite database every run is recorded in, "" to keep no history
+history_db = os.path.join(script_dir, "rsync-history.db")
 
 source_dirs = ["/opt", "/home"]
 target_dir = "/NAS"
 webhook_url = 'https://discord.com/api/webhooks/<embed>'
 
-start_time = time.time()
-hostname = os.uname()[1]
-source_dirs_string = " ".join(source_dirs)
-
-# Create the rsync.log file if it doesn't exist
-if not os.path.exists(log_file_path):
-    with open(log_file_path, "w") as log_file:
-        pass
+# Number of rsync processes to run at once. With more than 1, every source
+# dir gets its own rsync, and the dirs in split_dirs one per subdirectory
+workers = 1
+split_dirs = []
 
-with open(log_file_path, "a") as log_file:
-    result = subprocess.run(
-        f"rsync -rltvz -a --no-links --no-specials --no-devices --no-inc-recursive --delete --stats --info=progress2 --verbose {source_dirs_string} {target_dir}",
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+# rsync compression: "auto" decides per job from a sample of the source
+# files, or "none", "zlib" or "zstd", optionally with a level as in "zstd:3"
+compression = "auto"
 
-    )
-    output = result.stdout.decode()
-    log_file.write(output)
+# Keep a manifest of the source files in this SQLite database and only hand
+# the paths that changed to rsync, with a full sync every full_every days.
+# "" lets rsync walk the whole trees on every run
+manifest_db = ""
+full_every = 7
 
-match = re.search(
-    r"Number of files: ([\d,]+).*Number of created files: ([\d,]+).*Number of deleted files: ([\d,]+).*Number of regular files transferred: ([\d,]+).*",
-    output, re.DOTALL)
-if match:
-    synced = match.group(1)
-    created = match.group(2)
-    deleted = match.group(3)
-    transferred = match.group(4)
-else:
-    synced = 0
-    created = 0
-    deleted = 0
-    transferred = 0
+# Throttling, so backups do not get in the way of Plex or snapraid.
+# bwlimit_schedule holds ("HH:MM", "HH:MM", limit) times of day and the
+# rsync --bwlimit for them, e.g. [("07:00", "23:00", "20m")]
+bwlimit_schedule = []
+# Priority of rsync, None to leave it alone. ionice class 3 is idle
+nice = 10
+ionice_class = 3
+# Pause rsync while other I/O keeps one of these disks more than
+# pause_above % busy, until it is below resume_below %. e.g. ["sda", "sdb"]
+busy_disks = []
+pause_above = 80
+resume_below = 50
 
-print(synced, created, deleted, transferred)
+start_time = time.time()
+hostname = os.uname()[1]
 
-# Check for error code 23, 24, and 25 and set returncode to 0 if found
-if result.returncode in [23, 24, 25]:
-    result.returncode = 0
+rsync_args = ["rsync", "-rltv", "-a", "--no-links", "--no-specials",
+              "--no-devices", "--no-inc-recursive", "--delete", "--stats",
+              "--info=progress2", "--verbose"]
+jobs = plan_jobs(source_dirs, target_dir, split_dirs, split=workers > 1)
+apply_compression(jobs, compression)
 
-if result.returncode == 0:
-    duration_seconds = time.time() - start_time
-    duration_minutes, duration_seconds = divmod(duration_seconds, 60)
-    duration_seconds = round(duration_seconds, 0)
+with FileManifest(manifest_db, full_every) as manifest, \
+        Throttle(bwlimit_schedule, nice, ionice_class, busy_disks,
+                 pause_above, resume_below) as throttle:
+    jobs = manifest.plan(jobs)
+    returncode, stats, tail, reports = run_rsync_jobs(
+        rsync_args, jobs, log_file_path, workers=workers, throttle=throttle)
+    # 23 means some files were not sent, they must be looked at again
+    if returncode in (0, 24):
+        manifest.save()
 
+print(stats["synced"], stats["created"], stats["deleted"], stats["transferred"])
 
-    tz = pytz.timezone("America/New_York")
-    time_ny = datetime.now(tz).strftime("%I:%M %p")
-    date_ny = datetime.now(tz).strftime("%m/%d/%y")
-    embed = {
-        'title': hostname,
-        "thumbnail": {
-            "url": "https://i.imgur.com/dFqM7CG.png"
-        },
-        'fields': [
-            {
-                'name': 'Sync',
-                'value': synced,
-                'inline': True
-            },
-            {
-                'name': 'Transfer',
-                'value': transferred,
-                'inline': True
-            },
-            {
-                'name': 'Delete',
-                'value': deleted,
-                'inline': True
-            },
-            {
-                'name': 'Duration',
-                'value': f'{int(duration_minutes)} minutes {int(duration_seconds)} seconds',
-            },
-            {
-                'name': 'Date and Time',
-                'value': f'{date_ny} {time_ny}',
-            },
-        ],
-        'color': 12868102
-    }
-else:
-    with open(log_file_path, "r") as file:
-        error_output = file.read()
-        error_output = error_output[-2000:]
-        embed = {
-            'title': f'{hostname} rsync failed',
-            'description': f'```{error_output}```',
-            'color': 15158332,
-            'fields': [
-                {
-                    'name': 'Error Code',
-                    'value': result.returncode,
-                    'inline': True
-                }
-            ]
-        }
+usual_rate = None
+if history_db:
+    run_id = record_history(history_db, hostname, target_dir, start_time,
+                            returncode, stats, reports)
+    usual_rate = median_rate(history_db, hostname, target_dir, run_id)
 
-requests.post(webhook_url, json={'embeds': [embed]})
\ No newline at end of file
+send_discord(webhook_url, hostname, returncode, stats, start_time, tail,
+             reports, usual_rate)
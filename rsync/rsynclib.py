@@ -0,0 +1,951 @@
+"""
+Shared helpers for rsync.py and rsync-ssh.py: run rsync while streaming its
+output to the log, parse its --stats incrementally and report to Discord.
+"""
+import os
+import re
+import shlex
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import pytz
+
+# Notifications go through the shared homelab package in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homelab import notify  # noqa: E402
+
+# Exit codes for partial transfers (vanished files etc.), treated as success
+PARTIAL_TRANSFER_CODES = [23, 24, 25]
+
+# ssh options for the connection to the target, see ssh_config(5). The AES-GCM
+# profile is fastest on CPUs with AES-NI, chacha20 on those without.
+# Compression is left to rsync's -z.
+SSH_PROFILES = {
+    "default": [],
+    "aes-gcm": ["-c", "aes128-gcm@openssh.com,aes256-gcm@openssh.com",
+                "-o", "Compression=no"],
+    "chacha20": ["-c", "chacha20-poly1305@openssh.com", "-o", "Compression=no"],
+}
+
+# Exit codes worth another try: socket and protocol errors, timeouts, and
+# the ssh connection failing
+RETRY_CODES = [10, 12, 30, 35, 255]
+
+# How rsync keeps what it got of a file when it is interrupted, so the next
+# try continues from there. partial keeps it aside in .rsync-partial until
+# the file is complete, inplace writes straight into the target file.
+RESUME_MODES = {
+    "": [],
+    "partial": ["--partial-dir=.rsync-partial"],
+    "inplace": ["--inplace", "--partial"],
+}
+
+# Formats that are compressed already, rsync should not compress them again
+COMPRESSED_EXTENSIONS = {
+    "7z", "avi", "bz2", "deb", "flac", "gif", "gz", "heic", "iso", "jpeg",
+    "jpg", "lz4", "lzma", "m4a", "m4v", "mkv", "mov", "mp3", "mp4", "ogg",
+    "opus", "png", "rar", "rpm", "squashfs", "tbz", "tgz", "txz", "webm",
+    "webp", "xz", "zip", "zst",
+}
+
+# e.g. "  1,234,567  45%   12.34MB/s    0:00:12 (xfr#12, to-chk=100/2000)"
+PROGRESS_LINE = re.compile(r"\s*[\d,.]+[KMGT]?\s+\d+%\s+\S+/s\s+\d+:\d\d:\d\d")
+
+
+class StatsParser:
+    """
+    Picks the --stats values out of rsync output one line at a time, so the
+    output never has to be held in memory. Values rsync did not report stay
+    None rather than 0, so a missing stats block is not mistaken for an empty
+    transfer.
+    """
+    fields = {
+        "Number of files": "synced",
+        "Number of created files": "created",
+        "Number of deleted files": "deleted",
+        "Number of regular files transferred": "transferred",
+        "Total file size": "total_size",
+        "Total transferred file size": "transferred_size",
+        "Literal data": "literal_data",
+        "Matched data": "matched_data",
+        "File list size": "file_list_size",
+        "File list generation time": "file_list_generation_time",
+        "File list transfer time": "file_list_transfer_time",
+        "Total bytes sent": "bytes_sent",
+        "Total bytes received": "bytes_received",
+    }
+    # e.g. "sent 2,400,000 bytes  received 12,345 bytes  160,823.00 bytes/sec"
+    sent_line = re.compile(r"sent [\d,]+ bytes\s+received [\d,]+ bytes\s+"
+                           r"([\d,.]+) bytes/sec")
+    # e.g. "total size is 1,234,567,890  speedup is 511.76"
+    total_line = re.compile(r"total size is [\d,]+\s+speedup is ([\d,.]+)")
+
+    def __init__(self):
+        self.stats = dict.fromkeys(self.keys())
+
+    @classmethod
+    def keys(cls):
+        return list(cls.fields.values()) + ["rate", "speedup"]
+
+    @property
+    def missing(self):
+        """ The stats rsync did not report. """
+        return [key for key, value in self.stats.items() if value is None]
+
+    @classmethod
+    def merge(cls, all_stats, elapsed=None):
+        """
+        Add up the stats of several rsync runs. The speedup is worked out
+        again from the totals, and the rate from elapsed, the seconds all
+        runs took together. Both are None unless every run reported the
+        sizes they come from.
+        """
+        merged = cls().stats
+        # A total only stands for all runs if every run reported it
+        complete = dict.fromkeys(merged, True)
+        for stats in all_stats:
+            for key, value in stats.items():
+                if value is None:
+                    complete[key] = False
+                else:
+                    merged[key] = (merged[key] or 0) + value
+        sent, received = merged["bytes_sent"], merged["bytes_received"]
+        merged["speedup"] = merged["rate"] = None
+        if (complete["bytes_sent"] and complete["bytes_received"]
+                and sent is not None and received is not None):
+            if (complete["total_size"] and merged["total_size"] is not None
+                    and sent + received):
+                merged["speedup"] = merged["total_size"] / (sent + received)
+            merged["rate"] = (sent + received) / elapsed if elapsed else None
+        return merged
+
+    @staticmethod
+    def number(text):
+        text = text.replace(",", "")
+        return float(text) if "." in text else int(text)
+
+    def feed(self, line):
+        m = self.sent_line.match(line) or self.total_line.match(line)
+        if m:
+            key = "rate" if m.re is self.sent_line else "speedup"
+            self.stats[key] = float(m.group(1).replace(",", ""))
+            return
+        label, sep, value = line.partition(":")
+        key = self.fields.get(label.strip())
+        if sep and key and value.split():
+            self.stats[key] = self.number(value.split()[0])
+
+
+def stream_rsync(args, log_file, log_lock, live, progress_interval=60,
+                 throttle=None):
+    """
+    Run rsync with args, writing its output to log_file as it arrives.
+    log_lock guards the writes, as several rsyncs may share the log.
+    Progress updates are shown on the terminal if live is set and written to
+    the log every progress_interval seconds. A Throttle, if given, sets the
+    bandwidth limit and priority and may pause rsync while it runs.
+
+    Returns (returncode, stats, tail), where tail holds the last lines of
+    output for error reports.
+    """
+    parser = StatsParser()
+    tail = deque(maxlen=50)
+    last_progress_log = time.monotonic()
+    if throttle:
+        args = throttle.command(args)
+    # Text mode splits on \r as well, which rsync ends progress lines with
+    p = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    if throttle:
+        throttle.register(p.pid)
+    for line in p.stdout:
+        if PROGRESS_LINE.match(line):
+            if live:
+                print("\r" + line.rstrip(), end="", flush=True)
+            if time.monotonic() - last_progress_log >= progress_interval:
+                with log_lock:
+                    log_file.write(line)
+                    log_file.flush()
+                last_progress_log = time.monotonic()
+            continue
+        with log_lock:
+            log_file.write(line)
+        tail.append(line)
+        parser.feed(line)
+    returncode = p.wait()
+    if throttle:
+        throttle.unregister(p.pid)
+    if parser.missing and returncode in [0] + PARTIAL_TRANSFER_CODES:
+        with log_lock:
+            log_file.write("rsync did not report: "
+                           + ", ".join(parser.missing) + "\n")
+    return returncode, parser.stats, "".join(tail)
+
+
+def filter_escape(name):
+    """ name as an rsync filter pattern that matches only itself. """
+    if not any(c in name for c in "*?["):
+        return name
+    return "".join("\\" + c if c in "*?[\\" else c for c in name)
+
+
+def plan_jobs(source_dirs, target_dir, split_dirs=(), split=True):
+    """
+    Split a sync into jobs, dicts holding the extra rsync "args", the
+    "sources" and the "target". Without split, that is a single job for all
+    source dirs. Otherwise every source dir gets a job, and dirs listed in
+    split_dirs a job per top-level subdirectory plus one for the files
+    directly inside them.
+    """
+    if not split:
+        return [{"args": [], "sources": list(source_dirs), "target": target_dir}]
+    split_dirs = {d.rstrip("/") for d in split_dirs}
+    jobs = []
+    for source in source_dirs:
+        source = source.rstrip("/")
+        if source not in split_dirs:
+            jobs.append({"args": [], "sources": [source], "target": target_dir})
+            continue
+        target = os.path.join(target_dir, os.path.basename(source)) + "/"
+        with os.scandir(source) as it:
+            subdirs = sorted(e.path for e in it
+                             if e.is_dir(follow_symlinks=False))
+        for subdir in subdirs:
+            jobs.append({"args": [], "sources": [subdir], "target": target})
+        # The subdirectories are synced by their own jobs. Being excluded
+        # by name keeps --delete from removing them on the target, while
+        # subdirectories gone from the source are still deleted.
+        excludes = [f"--exclude=/{filter_escape(os.path.basename(d))}/"
+                    for d in subdirs]
+        jobs.append({"args": excludes, "sources": [source + "/"],
+                     "target": target})
+    return jobs
+
+
+def run_rsync_jobs(base_args, jobs, log_file_path, log_mode="a", workers=1,
+                   progress_interval=60, throttle=None, retries=0,
+                   retry_delay=60):
+    """
+    Run one rsync per job from plan_jobs, at most workers at once, all
+    writing to the same log, and all under throttle if one is given. Live
+    progress is only shown for a single worker, as several would overwrite
+    each other. Jobs failing with one of RETRY_CODES are run again up to
+    retries times, retry_delay seconds apart.
+
+    Returns (returncode, stats, tail, reports). stats are those of all jobs
+    added up, the returncode is the first one that is not a success or
+    partial transfer, and tail holds the output of the failed jobs.
+    reports has a dict per job with its sources, compression, duration,
+    send rate, the number of attempts and the bytes matched on retry, the
+    matched data of the retries. That includes partly sent files picked up
+    again, but also unchanged files rsync would have matched anyway, so it
+    is not the amount resumed. Without jobs, as when a manifest
+    finds nothing changed, every count is 0 and there is no rate.
+    """
+    if not jobs:
+        stats = dict.fromkeys(StatsParser.keys(), 0)
+        stats["rate"] = stats["speedup"] = None
+        return 0, stats, "", []
+    log_lock = threading.Lock()
+    live = sys.stdout.isatty() and workers == 1
+
+    def run_job(job):
+        started = time.monotonic()
+        matched_on_retry = 0
+        for attempt in range(1, retries + 2):
+            result = stream_rsync(
+                base_args + job["args"] + job["sources"] + [job["target"]],
+                log_file, log_lock, live, progress_interval, throttle)
+            if attempt > 1:
+                matched_on_retry += result[1]["matched_data"] or 0
+            if result[0] not in RETRY_CODES or attempt > retries:
+                break
+            with log_lock:
+                log_file.write(f"rsync exited with {result[0]}, trying again "
+                               f"in {retry_delay}s ({attempt} of {retries})\n")
+                log_file.flush()
+            time.sleep(retry_delay)
+        report = {
+            "sources": job["sources"],
+            "compression": job.get("compression", ""),
+            "duration": time.monotonic() - started,
+            "bytes_per_sec": result[1]["rate"],
+            "attempts": attempt,
+            "matched_on_retry": matched_on_retry,
+        }
+        return result + (report,)
+
+    started = time.monotonic()
+    with open(log_file_path, log_mode) as log_file, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_job, jobs))
+    if live:
+        print()
+    codes = [rc for rc, _, _, _ in results]
+    failed = [rc for rc in codes if rc != 0 and rc not in PARTIAL_TRANSFER_CODES]
+    returncode = failed[0] if failed else max(codes, default=0)
+    tail = "".join(t for rc, _, t, _ in results
+                   if rc != 0 and rc not in PARTIAL_TRANSFER_CODES)
+    stats = StatsParser.merge((s for _, s, _, _ in results),
+                              time.monotonic() - started)
+    return returncode, stats, tail, [r for _, _, _, r in results]
+
+
+class Throttle:
+    """
+    Keeps rsync from getting in the way of other work on the host.
+
+    bwlimit_schedule is a list of ("HH:MM", "HH:MM", limit) times of day with
+    the --bwlimit for rsyncs started between them, e.g.
+    [("07:00", "23:00", "20m")]. Outside of them rsync is not limited. rsync
+    runs with nice and the ionice class ionice_class (3 is idle) if those
+    are not None.
+
+    With busy_disks set, e.g. ["sda", "sdb"], the disks' busy time in
+    /proc/diskstats is checked every interval seconds. When the I/O of
+    other processes keeps a disk busier than pause_above percent, all rsyncs
+    are stopped with SIGSTOP. They are continued once the disk has been less
+    busy than resume_below percent. rsync's own share is estimated from
+    /proc/<pid>/io, so that its own I/O does not pause it.
+
+    rsync's --timeout also applies on the remote side, which ends a
+    connection that is paused for longer. With max_pause set, pauses are
+    cut short after max_pause seconds: rsync runs for one interval before
+    it can be paused again. Keep max_pause well below the --timeout.
+    """
+    def __init__(self, bwlimit_schedule=(), nice=None, ionice_class=None,
+                 busy_disks=(), pause_above=80, resume_below=50, interval=5,
+                 max_pause=None):
+        self.bwlimit_schedule = bwlimit_schedule
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.busy_disks = set(busy_disks)
+        self.pause_above = pause_above
+        self.resume_below = resume_below
+        self.interval = interval
+        self.max_pause = max_pause
+        self.pids = set()
+        self.paused = False
+        self.paused_since = None
+        self.paused_seconds = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.monitor = None
+
+    def __enter__(self):
+        if self.busy_disks:
+            self.monitor = threading.Thread(target=self.watch, daemon=True)
+            self.monitor.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        if self.monitor:
+            self.monitor.join()
+        self.set_paused(False)
+        if self.paused_seconds:
+            print(f"rsync was paused for {self.paused_seconds:.0f}s")
+
+    def bwlimit(self, now=None):
+        """ The --bwlimit for now from bwlimit_schedule, None for none. """
+        now = (now or datetime.now()).strftime("%H:%M")
+        for start, end, limit in self.bwlimit_schedule:
+            if start <= end and start <= now < end:
+                return limit
+            # Periods past midnight like ("22:00", "06:00")
+            if start > end and (now >= start or now < end):
+                return limit
+        return None
+
+    def command(self, args):
+        """ args with the bandwidth limit and the priority applied. """
+        limit = self.bwlimit()
+        if limit:
+            args = args[:1] + [f"--bwlimit={limit}"] + args[1:]
+        if self.nice is not None:
+            args = ["nice", "-n", str(self.nice)] + args
+        if self.ionice_class is not None and shutil.which("ionice"):
+            args = ["ionice", "-c", str(self.ionice_class)] + args
+        return args
+
+    def register(self, pid):
+        with self.lock:
+            self.pids.add(pid)
+            if self.paused:
+                self.signal(pid, signal.SIGSTOP)
+
+    def unregister(self, pid):
+        with self.lock:
+            self.pids.discard(pid)
+
+    @staticmethod
+    def process_tree(pid):
+        """ pid and all of its descendants. """
+        pids = [pid]
+        for p in pids:
+            try:
+                with open(f"/proc/{p}/task/{p}/children") as f:
+                    pids += [int(child) for child in f.read().split()]
+            except OSError:
+                pass
+        return pids
+
+    def signal(self, pid, signum):
+        for p in self.process_tree(pid):
+            try:
+                os.kill(p, signum)
+            except ProcessLookupError:
+                pass
+
+    def set_paused(self, paused):
+        with self.lock:
+            if paused == self.paused:
+                return
+            self.paused = paused
+            self.paused_since = time.monotonic() if paused else None
+            for pid in self.pids:
+                self.signal(pid, signal.SIGSTOP if paused else signal.SIGCONT)
+        print(f"{datetime.now():%H:%M:%S} rsync "
+              + ("paused, disks are busy" if paused else "resumed"))
+
+    def own_io(self):
+        """ Bytes read and written by the rsyncs so far, by pid. """
+        with self.lock:
+            pids = [p for pid in self.pids for p in self.process_tree(pid)]
+        io = {}
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/io") as f:
+                    fields = dict(line.split(": ") for line in f)
+            except (OSError, ValueError):
+                continue
+            io[pid] = int(fields["read_bytes"]) + int(fields["write_bytes"])
+        return io
+
+    def disk_io(self):
+        """ Busy milliseconds and bytes moved so far of each busy disk. """
+        disks = {}
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                if fields[2] in self.busy_disks:
+                    disks[fields[2]] = (
+                        int(fields[12]),
+                        (int(fields[5]) + int(fields[9])) * 512)
+        return disks
+
+    def watch(self):
+        last_disks, last_own = self.disk_io(), self.own_io()
+        last_time = time.monotonic()
+        # Set after a pause was cut short, to let rsync run for an interval
+        hold = False
+        while not self.stop.wait(self.interval):
+            disks, own = self.disk_io(), self.own_io()
+            now = time.monotonic()
+            elapsed_ms = (now - last_time) * 1000
+            own_bytes = sum(own[pid] - last_own.get(pid, 0) for pid in own)
+            busiest = 0
+            for name, (ticks, moved) in disks.items():
+                last_ticks, last_moved = last_disks.get(name, (ticks, moved))
+                busy = 100 * (ticks - last_ticks) / elapsed_ms
+                moved -= last_moved
+                # Only count the share of the disk's I/O that is not rsync's
+                if moved:
+                    busy *= max(moved - own_bytes, 0) / moved
+                busiest = max(busiest, busy)
+            if self.paused:
+                self.paused_seconds += now - last_time
+                if busiest < self.resume_below:
+                    self.set_paused(False)
+                elif (self.max_pause
+                        and now - self.paused_since >= self.max_pause):
+                    # Let the connection move data before --timeout ends it
+                    self.set_paused(False)
+                    hold = True
+            elif busiest > self.pause_above and not hold:
+                self.set_paused(True)
+            else:
+                hold = False
+            last_disks, last_own, last_time = disks, own, now
+
+
+def rsync_compress_choices():
+    """
+    Return the compression algorithms the installed rsync supports, empty
+    for rsync older than 3.2, which only knows zlib
+    """
+    output = subprocess.run(["rsync", "--version"], capture_output=True,
+                            text=True).stdout
+    m = re.search(r"Compress list:\s*(.*)", output)
+    return m.group(1).split() if m else []
+
+
+def sample_compressibility(sources, max_files=2000, max_dirs=200,
+                           probe_files=50, probe_bytes=65536):
+    """
+    Look at the names of up to max_files files in up to max_dirs
+    directories below sources, whatever their type. Returns the share of
+    those files with already compressed formats, the zlib ratio of the
+    first probe_bytes of up to probe_files other files, and the extensions
+    of probed files that did not compress. Only the probed files are
+    opened, the rest is decided by name.
+    """
+    examined = skipped = dirs = 0
+    candidates = []
+    for source in sources:
+        for root, _, files in os.walk(source):
+            dirs += 1
+            for name in files:
+                examined += 1
+                ext = os.path.splitext(name)[1][1:].lower()
+                if ext in COMPRESSED_EXTENSIONS:
+                    skipped += 1
+                else:
+                    candidates.append((os.path.join(root, name), ext))
+                if examined >= max_files:
+                    break
+            if examined >= max_files or dirs >= max_dirs:
+                break
+        if examined >= max_files or dirs >= max_dirs:
+            break
+    raw = packed = 0
+    incompressible = set()
+    step = max(len(candidates) // probe_files, 1)
+    for path, ext in candidates[::step][:probe_files]:
+        try:
+            with open(path, "rb") as f:
+                probe = f.read(probe_bytes)
+        except OSError:
+            continue
+        if not probe:
+            continue
+        probe_packed = len(zlib.compress(probe, 1))
+        raw += len(probe)
+        packed += probe_packed
+        if ext and probe_packed > 0.95 * len(probe):
+            incompressible.add(ext)
+    return (skipped / examined if examined else 0,
+            packed / raw if raw else 1,
+            incompressible)
+
+
+def compression_args(algorithm, level, skip_extensions, choices):
+    """ rsync options for algorithm ("zlib" or "zstd") at level. """
+    if algorithm == "zstd" and "zstd" not in choices:
+        print("rsync does not support zstd, using zlib")
+        algorithm, level = "zlib", None
+    args = ["-z"]
+    if choices:
+        args.append("--compress-choice=" + algorithm)
+    if level is not None:
+        args.append(f"--compress-level={level}")
+    args.append("--skip-compress=" + "/".join(sorted(skip_extensions)))
+    return args, f"{algorithm} {level}" if level is not None else algorithm
+
+
+def apply_compression(jobs, compression):
+    """
+    Add compression options to every job. compression is "none", "zlib" or
+    "zstd" with an optional level like "zstd:3", or "auto", which skips
+    compression for local targets and for sources that are mostly already
+    compressed and uses zstd (zlib on older rsync) otherwise.
+    """
+    choices = rsync_compress_choices()
+    algorithm, _, level = compression.partition(":")
+    for job in jobs:
+        if algorithm == "none" or (algorithm == "auto" and
+                                   ":" not in job["target"]):
+            job["compression"] = "none"
+            continue
+        skip = set(COMPRESSED_EXTENSIONS)
+        if algorithm == "auto":
+            compressed_share, ratio, incompressible = \
+                sample_compressibility(job["sources"])
+            skip |= incompressible
+            if compressed_share > 0.8 or ratio > 0.9:
+                job["compression"] = "none"
+                continue
+            job_algorithm = "zstd" if "zstd" in choices else "zlib"
+            job_level = 3 if job_algorithm == "zstd" else 6
+        else:
+            job_algorithm, job_level = algorithm, int(level) if level else None
+        args, job["compression"] = compression_args(
+            job_algorithm, job_level, skip, choices)
+        job["args"] = job["args"] + args
+
+
+def scan_tree(roots, workers=8):
+    """
+    Walk roots with workers threads, each listing one directory at a time.
+    Returns {path: (size, mtime_ns, inode)} for every regular file and
+    directory, with None as size for directories. Like the rsync options
+    used here, links, devices and special files are left out.
+    """
+    def scan(path):
+        found = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        found.append((entry.path, (None, 0, entry.inode())))
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        found.append((entry.path, (st.st_size, st.st_mtime_ns,
+                                                   st.st_ino)))
+        except OSError as e:
+            print(f"Cannot scan {path}: {e}")
+        return found
+
+    entries = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan, root) for root in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for path, entry in future.result():
+                    entries[path] = entry
+                    if entry[0] is None:
+                        pending.add(pool.submit(scan, path))
+    return entries
+
+
+class FileManifest:
+    """
+    Keeps the size, mtime and inode of every source file from the last
+    successful run in an SQLite database, so rsync can be given only the
+    paths that changed since then through --files-from instead of walking
+    the whole trees. Every full_every days, and whenever there is no
+    manifest yet, the jobs run unchanged as a full verification. Without a
+    db_path the jobs always run unchanged.
+
+        with FileManifest(path, full_every) as manifest:
+            jobs = manifest.plan(jobs)
+            ...
+            manifest.save()
+    """
+    def __init__(self, db_path, full_every=7, workers=8):
+        self.db_path = db_path
+        self.full_every = full_every
+        self.workers = workers
+        self.full = True
+        self.entries = None
+        self.list_dir = None
+
+    def __enter__(self):
+        if not self.db_path:
+            return self
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files"
+                        " (path TEXT PRIMARY KEY, size INTEGER,"
+                        " mtime_ns INTEGER, inode INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta"
+                        " (key TEXT PRIMARY KEY, value)")
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.db_path:
+            self.db.close()
+        if self.list_dir:
+            shutil.rmtree(self.list_dir, ignore_errors=True)
+
+    def last_full(self):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'last_full'").fetchone()
+        return row[0] if row else None
+
+    def plan(self, jobs):
+        """
+        Scan the sources of jobs and return the jobs to run. For a full run
+        these are jobs themselves, otherwise one job per source of jobs
+        that sends and deletes only the changed paths.
+        """
+        if not self.db_path:
+            return jobs
+        roots = sorted({s.rstrip("/") for job in jobs for s in job["sources"]})
+        # Split jobs have sources inside other sources, scan those only once
+        roots = [r for r in roots
+                 if not any(r.startswith(o + "/") for o in roots)]
+        started = time.monotonic()
+        self.entries = scan_tree(roots, self.workers)
+        print(f"Scanned {len(self.entries)} paths in "
+              f"{time.monotonic() - started:.1f}s")
+        last_full = self.last_full()
+        self.full = (last_full is None
+                     or time.time() - last_full > self.full_every * 86400)
+        if self.full:
+            print("Running a full sync to verify the manifest")
+            return jobs
+
+        changed = []
+        for path, size, mtime_ns, inode in self.db.execute(
+                "SELECT path, size, mtime_ns, inode FROM files"):
+            entry = self.entries.get(path)
+            if entry is None:
+                # Deleting the parent deletes everything below it
+                parent = os.path.dirname(path)
+                if parent in self.entries or parent in roots:
+                    changed.append(path)
+            elif entry != (size, mtime_ns, inode):
+                changed.append(path)
+        known = {row[0] for row in self.db.execute("SELECT path FROM files")}
+        changed += [path for path in self.entries if path not in known]
+        print(f"{len(changed)} paths changed since the last run")
+
+        # Every path goes to the job with the most specific source
+        sources = sorted(((s.rstrip("/"), i, s.endswith("/"))
+                          for i, job in enumerate(jobs)
+                          for s in job["sources"]),
+                         key=lambda source: -len(source[0]))
+        lists = {}
+        for path in changed:
+            for source, i, contents in sources:
+                if path.startswith(source + "/"):
+                    base = source if contents else os.path.dirname(source)
+                    lists.setdefault((i, base), []).append(
+                        os.path.relpath(path, base))
+                    break
+        self.list_dir = tempfile.mkdtemp(prefix="rsync-files-from-")
+        planned = []
+        for (i, base), paths in sorted(lists.items()):
+            list_path = os.path.join(self.list_dir, f"{len(planned)}.list")
+            with open(list_path, "w") as f:
+                f.write("\0".join(sorted(paths)) + "\0")
+            args = [f"--files-from={list_path}", "--from0",
+                    "--delete-missing-args"]
+            planned.append(dict(jobs[i], args=jobs[i]["args"] + args,
+                                sources=[base + "/"]))
+        return planned
+
+    def save(self):
+        """ Store the scan from plan as the state the target is now in. """
+        if not self.db_path:
+            return
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                ((path,) + entry for path, entry in self.entries.items()))
+            if self.full:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES"
+                                " ('last_full', ?)", (time.time(),))
+
+
+def remote_host(target):
+    """ Return the [user@]host part of an rsync target like user@host:/path. """
+    host, sep, _ = target.partition(":")
+    if not sep or "/" in host:
+        raise ValueError(f"{target} is not a remote rsync target")
+    return host
+
+
+class SSHMaster:
+    """
+    A persistent ssh ControlMaster connection to host. rsync (through rsh)
+    and remote commands (through run) reuse it instead of each doing a full
+    ssh handshake. Use it as a context manager to open and close it.
+    """
+    def __init__(self, host, private_key, options=()):
+        self.host = host
+        self.socket_dir = None
+        self.private_key = private_key
+        self.options = list(options)
+
+    def ssh_args(self):
+        # If the master connection is lost, ssh connects on its own, so the
+        # options are passed every time
+        return ["ssh", "-i", self.private_key,
+                "-o", "ControlPath=" + os.path.join(self.socket_dir, "master")
+                ] + self.options
+
+    @property
+    def rsh(self):
+        """ The ssh command line for rsync's -e option. """
+        return " ".join(shlex.quote(arg) for arg in self.ssh_args())
+
+    def __enter__(self):
+        self.socket_dir = tempfile.mkdtemp(prefix="rsync-ssh-")
+        result = subprocess.run(
+            self.ssh_args() + ["-o", "ControlMaster=yes", "-f", "-N",
+                               self.host],
+            stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        if result.returncode != 0:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            raise ConnectionError(
+                f"ssh connection to {self.host} failed: {result.stderr.strip()}")
+        return self
+
+    def run(self, command):
+        """ Run a shell command on the host, returns the CompletedProcess. """
+        return subprocess.run(self.ssh_args() + [self.host, command],
+                              stdin=subprocess.DEVNULL, capture_output=True,
+                              text=True)
+
+    def __exit__(self, *exc_info):
+        subprocess.run(self.ssh_args() + ["-O", "exit", self.host],
+                       stdin=subprocess.DEVNULL, capture_output=True)
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def record_history(db_path, hostname, target, start_time, returncode, stats,
+                   reports=()):
+    """
+    Append a run to the history table in the SQLite database at db_path,
+    one row per run with every stat as a column, and return its rowid.
+    Export with e.g. sqlite3 -csv rsync-history.db "select * from runs"
+    """
+    columns = StatsParser.keys()
+    with sqlite3.connect(db_path) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS runs (started TEXT,"
+                   " hostname TEXT, target TEXT, returncode INTEGER,"
+                   " duration REAL, compression TEXT)")
+        existing = {row[1] for row in db.execute("PRAGMA table_info(runs)")}
+        for column in columns:
+            if column not in existing:
+                db.execute(f"ALTER TABLE runs ADD COLUMN {column} NUMERIC")
+        stats = stats or {}
+        started = datetime.fromtimestamp(start_time)
+        values = [started.isoformat(timespec="seconds"), hostname, target,
+                  returncode, time.time() - start_time,
+                  ", ".join(sorted({r["compression"] for r in reports}))]
+        values += [stats.get(column) for column in columns]
+        names = ["started", "hostname", "target", "returncode", "duration",
+                 "compression"] + columns
+        rowid = db.execute(f"INSERT INTO runs ({', '.join(names)})"
+                           f" VALUES ({', '.join('?' * len(names))})",
+                           values).lastrowid
+    db.close()
+    return rowid
+
+
+def median_rate(db_path, hostname, target, exclude=None, runs=10):
+    """
+    The median rate of the last successful runs, leaving out the run with
+    rowid exclude (the one just recorded) to compare it against. None
+    without enough history.
+    """
+    with sqlite3.connect(db_path) as db:
+        rates = [row[0] for row in db.execute(
+            "SELECT rate FROM runs WHERE hostname = ? AND target = ?"
+            " AND returncode IN (0, 23, 24, 25) AND rate IS NOT NULL"
+            " AND rowid IS NOT ? ORDER BY started DESC LIMIT ?",
+            (hostname, target, exclude, runs))]
+    db.close()
+    rates = sorted(rates)
+    if len(rates) < 3:
+        return None
+    return rates[len(rates) // 2]
+
+
+def send_discord(webhook_url, hostname, returncode, stats, start_time, tail,
+                 reports=(), usual_rate=None):
+    """
+    Post the result of a run to the Discord webhook. reports are the per job
+    reports from run_rsync_jobs, used for the compression, and usual_rate
+    the rate to compare the throughput with.
+    """
+    def count(key):
+        return "unknown" if stats[key] is None else stats[key]
+
+    if returncode in PARTIAL_TRANSFER_CODES:
+        returncode = 0
+
+    if returncode == 0:
+        duration_seconds = time.time() - start_time
+        duration_minutes, duration_seconds = divmod(duration_seconds, 60)
+        duration_seconds = round(duration_seconds, 0)
+
+        tz = pytz.timezone("America/New_York")
+        time_ny = datetime.now(tz).strftime("%I:%M %p")
+        date_ny = datetime.now(tz).strftime("%m/%d/%y")
+        embed = {
+            'title': hostname,
+            "thumbnail": {
+                "url": "https://i.imgur.com/dFqM7CG.png"
+            },
+            'fields': [
+                {
+                    'name': 'Sync',
+                    'value': count("synced"),
+                    'inline': True
+                },
+                {
+                    'name': 'Transfer',
+                    'value': count("transferred"),
+                    'inline': True
+                },
+                {
+                    'name': 'Delete',
+                    'value': count("deleted"),
+                    'inline': True
+                },
+                {
+                    'name': 'Duration',
+                    'value': f'{int(duration_minutes)} minutes {int(duration_seconds)} seconds',
+                },
+                {
+                    'name': 'Date and Time',
+                    'value': f'{date_ny} {time_ny}',
+                },
+            ],
+            'color': 12868102
+        }
+        if reports:
+            compressions = sorted({r["compression"] for r in reports})
+            throughput = "unknown"
+            if stats["rate"] is not None:
+                throughput = f'{stats["rate"] / 1e6:.1f} MB/s'
+                if stats["speedup"] is not None:
+                    throughput += f', speedup {stats["speedup"]:.1f}'
+                if usual_rate:
+                    throughput += f' (usually {usual_rate / 1e6:.1f} MB/s)'
+            retried = sum(r["attempts"] - 1 for r in reports)
+            if retried:
+                matched = sum(r["matched_on_retry"] for r in reports)
+                embed['fields'].insert(3, {
+                    'name': 'Retries',
+                    'value': f'{retried}, matched on retry '
+                             f'{matched / 1e6:.1f} MB',
+                    'inline': True
+                })
+            embed['fields'][3:3] = [
+                {
+                    'name': 'Compression',
+                    'value': ", ".join(compressions),
+                    'inline': True
+                },
+                {
+                    'name': 'Throughput',
+                    'value': throughput,
+                    'inline': True
+                },
+            ]
+    else:
+        embed = {
+            'title': f'{hostname} rsync failed',
+            'description': f'```{tail[-2000:]}```',
+            'color': 15158332,
+            'fields': [
+                {
+                    'name': 'Error Code',
+                    'value': returncode,
+                    'inline': True
+                }
+            ]
+        }
+
+    notify.send_discord(webhook_url, [embed])
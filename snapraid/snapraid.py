@@ -1,127 +1,606 @@
 #!/usr/bin/env python3
-import argparse
-import configparser
-import logging.handlers
+# Modules only needed for part of a run are imported where they are used,
+# so importing the runner stays cheap
 import os.path
-import subprocess
+import re
 import sys
 import logging
-import datetime
-import threading
 import time
-import traceback
-from collections import Counter, defaultdict
-from functools import cmp_to_key
-from io import StringIO
+from collections import defaultdict, deque
+
+# Shared helpers come from the homelab package in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Log levels for snapraid's stdout and stderr
+OUTPUT = 15
+OUTERR = 25
 
 # Global variables
 config = None
 email_log = None
-start_time = time.time()
-script_dir = os.path.dirname(os.path.abspath(__file__))
-log_file_path = os.path.join(script_dir, "snapraid.log")
+summary = None
+lock_file = None
+
+# Patterns are compiled where they are used, as compiling them all takes
+# longer than the rest of the import.
+# Snapraid ends progress lines with \r, so treat it as a line break as well
+NEWLINE = r"\r\n|\r|\n"
+# Errors worth retrying: the array lock is held by another snapraid process,
+# or a disk is busy or not ready yet
+TRANSIENT_ERROR = (
+    r"(?i)lock file|used by another process|already in use|"
+    r"device or resource busy|resource temporarily unavailable")
+# e.g. "64%, 234567 MB, 567 MB/s, 1234 stripe/s, CPU 14%, 2:31 ETA"
+PROGRESS_LINE = (
+    r"\s*(\d+)%, (\d+) MB(?:, (\d+) MB/s)?(?:, (\d+) stripe/s)?"
+    r"(?:, CPU (\d+)%)?(?:, (\d+):(\d+) ETA)?\s*$")
+# e.g. "100% completed, 234567 MB accessed in 2:31"
+COMPLETED_LINE = r"\s*100% completed, (\d+) MB accessed in (\d+):(\d+)"
+# e.g. "      d1  12% | *****", the share of time spent waiting on each disk
+WAIT_LINE = r"\s*(\S+)\s+(\d+)% \|"
 
-def tee_log(infile, out_lines, log_level):
+class RunSummary:
     """
-    Create a thread that saves all the output on infile to out_lines and
-    logs every line with log_level
+    Structured result of a run: the diff counts and the duration and exit
+    code of every snapraid command. It is handed to the notifiers, so they
+    never need to look at the log.
     """
-    def tee_thread():
-        for line in iter(infile.readline, ""):
-            logging.log(log_level, line.rstrip())
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.diff = None
+        self.phases = {}
+        # Percentage of the array scrubbed, and of each data disk
+        self.scrub = None
+        self.error = ""
+        self.success = None
+
+    def record_phase(self, name, duration, returncode, metrics=None):
+        self.phases[name] = {"duration": duration, "returncode": returncode}
+        if metrics is not None:
+            self.phases[name]["metrics"] = metrics
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start_time
+
+
+def tee_output(p, line_handlers, out_lines, err_lines):
+    """
+    Log every line p writes to stdout (as OUTPUT) and stderr (as OUTERR) in
+    the order the lines arrive, using a single selector loop for both pipes.
+    Stdout lines are also passed to each of line_handlers and, unless
+    out_lines is None, saved to out_lines. Stderr lines are appended to
+    err_lines.
+    """
+    import codecs
+    import selectors
+    newline = re.compile(NEWLINE)
+    progress_line = re.compile(PROGRESS_LINE)
+
+    def emit_stdout(line):
+        # Progress updates would flood the log, they are only parsed
+        level = logging.DEBUG if progress_line.match(line) else OUTPUT
+        logging.log(level, line.rstrip())
+        line += "\n"
+        for handler in line_handlers:
+            handler(line)
+        if out_lines is not None:
             out_lines.append(line)
-        infile.close()
-    t = threading.Thread(target=tee_thread)
-    t.daemon = True
-    t.start()
-    return t
 
-def snapraid_command(command, args={}, *, allow_statuscodes=[]):
+    def emit_stderr(line):
+        logging.log(OUTERR, line.rstrip())
+        err_lines.append(line)
+
+    selector = selectors.DefaultSelector()
+    for stream, emit in ((p.stdout, emit_stdout), (p.stderr, emit_stderr)):
+        # Snapraid always outputs utf-8 on windows. On linux, utf-8
+        # also seems a sensible assumption.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        selector.register(stream, selectors.EVENT_READ, [decoder, "", emit])
+
+    while selector.get_map():
+        for key, _ in selector.select():
+            decoder, pending, emit = key.data
+            chunk = os.read(key.fd, 65536)
+            text = pending + decoder.decode(chunk, final=not chunk)
+            if not chunk:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                # A held \r on its own is not a line
+                text = text.rstrip("\r\n")
+                if text:
+                    for line in newline.split(text):
+                        emit(line)
+                continue
+            # A trailing \r might be the first half of a \r\n
+            held = "\r" if text.endswith("\r") else ""
+            lines = newline.split(text[:len(text) - len(held)])
+            key.data[1] = lines.pop() + held
+            for line in lines:
+                emit(line)
+    selector.close()
+
+def snapraid_command(command, args={}, *, allow_statuscodes=[],
+                     line_handlers=None):
     """
     Run snapraid command
     Raises subprocess.CalledProcessError if errorlevel != 0
+
+    By default all stdout lines are collected and returned. If line_handlers
+    is given, every stdout line is passed to each handler as it arrives
+    instead and nothing is kept, so memory use does not grow with the
+    amount of output.
     """
-    arguments = ["--conf", config["snapraid"]["config"],
-                 "--quiet"]
+    import subprocess
+    arguments = ["--conf", config["snapraid"]["config"]]
+    metrics = None
+    if config["metrics"]["progress"]:
+        metrics = PhaseMetrics()
+        line_handlers = list(line_handlers or ()) + [metrics]
+    else:
+        arguments.append("--quiet")
     for (k, v) in args.items():
         arguments.append("--" + k)
         if v != '':
             arguments.append(str(v))
+    started = time.monotonic()
     p = subprocess.Popen(
         [config["snapraid"]["executable"], command] + arguments,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        # Snapraid always outputs utf-8 on windows. On linux, utf-8
-        # also seems a sensible assumption.
-        encoding="utf-8",
-        errors="replace")
-    out = []
-    threads = [
-        tee_log(p.stdout, out, logging.OUTPUT),
-        tee_log(p.stderr, [], logging.OUTERR)]
-    for t in threads:
-        t.join()
+        stderr=subprocess.PIPE)
+    out = [] if line_handlers is None else None
+    # The last stderr lines tell transient errors apart from fatal ones
+    err = deque(maxlen=20)
+    tee_output(p, line_handlers or (), out, err)
     ret = p.wait()
-    # sleep for a while to make pervent output mixup
-    time.sleep(0.3)
+    if summary is not None:
+        summary.record_phase(command, time.monotonic() - started, ret,
+                             metrics and metrics.as_dict())
     if ret == 0 or ret in allow_statuscodes:
         return out
     else:
-        raise subprocess.CalledProcessError(ret, "snapraid " + command)
+        raise subprocess.CalledProcessError(
+            ret, "snapraid " + command, stderr="\n".join(err))
 
 
-def send_discord(success, exception_msg="", log_path=log_file_path, duration=0):
-    end_time = time.time()
-    duration = end_time - start_time  # This gives the duration in seconds
+class PhaseMetrics:
+    """
+    Line handler turning snapraid's progress and completion output of one
+    command into throughput metrics
+    """
+    def __init__(self):
+        self.progress_line = re.compile(PROGRESS_LINE)
+        self.completed_line = re.compile(COMPLETED_LINE)
+        self.wait_line = re.compile(WAIT_LINE)
+        self.samples = 0
+        self.percent = 0
+        self.processed_mb = 0
+        self.speed_sum = 0
+        self.speed_max = 0
+        self.cpu_sum = 0
+        self.eta_minutes = None
+        self.accessed_mb = None
+        self.disk_wait = {}
 
+    def __call__(self, line):
+        m = self.progress_line.match(line)
+        if m:
+            percent, mb, speed, _, cpu, eta_h, eta_m = m.groups()
+            self.percent = int(percent)
+            self.processed_mb = int(mb)
+            if speed is not None:
+                self.samples += 1
+                self.speed_sum += int(speed)
+                self.speed_max = max(self.speed_max, int(speed))
+                self.cpu_sum += int(cpu or 0)
+            if eta_h is not None:
+                self.eta_minutes = int(eta_h) * 60 + int(eta_m)
+            return
+        m = self.completed_line.match(line)
+        if m:
+            self.percent = 100
+            self.accessed_mb = int(m.group(1))
+            return
+        m = self.wait_line.match(line)
+        if m and self.accessed_mb is not None:
+            self.disk_wait[m.group(1)] = int(m.group(2))
+
+    def as_dict(self):
+        return {
+            "percent": self.percent,
+            "processed_mb": self.accessed_mb or self.processed_mb,
+            "speed_mb_s_avg": (self.speed_sum / self.samples
+                               if self.samples else None),
+            "speed_mb_s_max": self.speed_max if self.samples else None,
+            "cpu_percent_avg": (self.cpu_sum / self.samples
+                                if self.samples else None),
+            "eta_minutes": self.eta_minutes,
+            "disk_wait_percent": self.disk_wait,
+        }
+
+
+class DiffCounter:
+    """
+    Line handler counting the change types in snapraid diff output as it is
+    produced
+    """
+    change_types = ("add", "remove", "move", "update")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.change_types, 0)
+
+    def __call__(self, line):
+        change_type = line.split(" ", 1)[0]
+        if change_type in self.counts:
+            self.counts[change_type] += 1
+
+
+def read_data_disks(snapraid_conf):
+    """
+    Return a dict of data disk name -> mount directory as configured in the
+    snapraid config file
+    """
+    disks = {}
+    with open(snapraid_conf, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            parts = line.split(None, 2)
+            # "disk" is the pre 11.0 name of the "data" option
+            if len(parts) == 3 and parts[0] in ("data", "disk"):
+                disks[parts[1]] = parts[2].strip()
+    return disks
+
+
+class DiffIndex:
+    """
+    SQLite index of the changes reported by snapraid diff, kept for the
+    last few runs, so changed and deleted files can be looked up by path
+    without re-running diff or reading old logs. Instances are line
+    handlers for the diff command.
+    """
+    change_types = ("add", "remove", "update", "move", "copy", "restore")
+
+    def __init__(self, path, data_disks=None):
+        import sqlite3
+        self.con = sqlite3.connect(path)
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                started REAL NOT NULL,
+                synced INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS changes (
+                run INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                change TEXT NOT NULL,
+                disk TEXT,
+                target TEXT,
+                PRIMARY KEY (run, path)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS changes_by_type
+                ON changes (run, change, path);
+        """)
+        # Longest mount directory first, so nested mounts match correctly
+        self.disk_dirs = sorted(
+            ((os.path.join(os.path.normpath(d), ""), name)
+             for name, d in (data_disks or {}).items()),
+            key=lambda x: len(x[0]), reverse=True)
+        self.run_id = None
+
+    def start_run(self):
+        self.run_id = self.con.execute(
+            "INSERT INTO runs (started) VALUES (?)",
+            (time.time(),)).lastrowid
+
+    def disk_of(self, path):
+        """
+        The data disk of a path from diff. Full paths are matched against
+        the mount directories. Paths relative to a disk go to the disk they
+        exist on, which leaves removed files without a disk unless the
+        array has a single one.
+        """
+        if os.path.isabs(path):
+            path = os.path.normpath(path)
+            for directory, name in self.disk_dirs:
+                if os.path.join(path, "").startswith(directory):
+                    return name
+            return None
+        found = [name for directory, name in self.disk_dirs
+                 if os.path.lexists(os.path.join(directory, path))]
+        if len(found) == 1:
+            return found[0]
+        if len(self.disk_dirs) == 1:
+            return self.disk_dirs[0][1]
+        return None
+
+    def __call__(self, line):
+        change, _, path = line.rstrip("\n").partition(" ")
+        if change not in self.change_types or not path:
+            return
+        target = None
+        if change in ("move", "copy"):
+            path, _, target = path.partition(" -> ")
+        self.con.execute(
+            "INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)",
+            (self.run_id, path, change, self.disk_of(path), target))
+
+    def finish_run(self, keep):
+        """ Commit the current run and drop all but the last keep runs. """
+        if keep > 0:
+            self.con.execute(
+                "DELETE FROM changes WHERE run <= ?", (self.run_id - keep,))
+            self.con.execute(
+                "DELETE FROM runs WHERE id <= ?", (self.run_id - keep,))
+        self.con.commit()
+
+    def mark_synced(self):
+        self.con.execute(
+            "UPDATE runs SET synced = 1 WHERE id = ?", (self.run_id,))
+        self.con.commit()
+
+    def changes(self, change=None):
+        """
+        Yield (change, path, disk, target) for the changes found by the most
+        recent run, optionally only those of one change type
+        """
+        run_id = self.con.execute("SELECT max(id) FROM runs").fetchone()[0]
+        query = "SELECT change, path, disk, target FROM changes WHERE run = ?"
+        params = [run_id]
+        if change:
+            query += " AND change = ?"
+            params.append(change)
+        yield from self.con.execute(query + " ORDER BY path", params)
+
+    def close(self):
+        self.con.close()
+
+
+def load_state(path):
+    """ Load the runner's persisted JSON state, empty if there is none yet. """
     import json
-    import urllib.request
-    import re
-    from datetime import datetime
-    from pytz import timezone
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    import json
+    from homelab.metrics import write_atomic
+    write_atomic(path, json.dumps(state, indent=2, sort_keys=True) + "\n")
+
+
+def scrub_percentage(plan):
+    """
+    The percentage to scrub: plan, lowered to what fits in scrub.window
+    minutes at the speed the last scrubs had. At least 1, so coverage
+    always moves on.
+    """
+    window = config["scrub"]["window"] * 60
+    state = load_state(config["scrub"]["statefile"]) if window else {}
+    seconds_per_percent = state.get("scrub", {}).get("seconds-per-percent")
+    if not seconds_per_percent:
+        return plan
+    fits = max(int(window / seconds_per_percent), 1)
+    if fits < plan:
+        logging.info("Scrubbing {}% instead of {}% to finish within {} "
+                     "minutes".format(fits, plan, config["scrub"]["window"]))
+    return min(plan, fits)
+
+
+def save_scrub_speed(percentage, seconds):
+    """
+    Remember how long scrubbing one percent took, averaged with the runs
+    before, so a single slow or fast night does not swing the next plan.
+    """
+    statefile = config["scrub"]["statefile"]
+    state = load_state(statefile)
+    scrub = state.setdefault("scrub", {})
+    speed = seconds / percentage
+    previous = scrub.get("seconds-per-percent")
+    scrub["seconds-per-percent"] = (speed if previous is None
+                                    else (previous + speed) / 2)
+    save_state(statefile, state)
 
-    url = config['discord']['webhook']
-    est = timezone('EST')
-    date_time = datetime.now(est)
 
-    # convert duration to appropriate format
-    def format_duration(seconds):
-        if seconds < 60:
-            return str(round(seconds, 2)) + " seconds"
-        elif seconds < 3600:
-            return str(round(seconds / 60, 2)) + " minutes"
+def read_content_files(snapraid_conf):
+    """ Return the content file paths configured in the snapraid config. """
+    with open(snapraid_conf, encoding="utf-8", errors="replace") as f:
+        return [line.split(None, 1)[1].strip() for line in f
+                if line.startswith("content ") and len(line.split()) > 1]
+
+
+def disk_fingerprint(directory, ignore=()):
+    """
+    Cheap fingerprint of the tree on a data disk: the mtimes of all
+    directories, which change whenever a file is added, removed or renamed,
+    without a stat() of every file. Directories holding one of the ignore
+    paths, at any level, are fingerprinted by their other entry names
+    instead, as snapraid replaces its content files on every sync. The root
+    always is. Files modified in place are not noticed.
+    """
+    import hashlib
+    directory = os.path.normpath(directory)
+    ignore = {os.path.normpath(path) for path in ignore}
+    by_names = {os.path.dirname(path) for path in ignore} | {directory}
+    fingerprint = hashlib.sha1()
+    stack = [directory]
+    while stack:
+        path = stack.pop()
+        with os.scandir(path) as it:
+            entries = sorted((e for e in it if e.path not in ignore),
+                             key=lambda e: e.name)
+        if path in by_names:
+            stamp = "\0".join(e.name for e in entries)
         else:
-            return str(round(seconds / 3600, 2)) + " hours"
+            stamp = os.stat(path, follow_symlinks=False).st_mtime_ns
+        fingerprint.update("{}\0{}\0".format(path, stamp).encode(
+            "utf-8", "surrogateescape"))
+        stack.extend(e.path for e in reversed(entries)
+                     if e.is_dir(follow_symlinks=False))
+    return fingerprint.hexdigest()
 
-    if success:
-        with open(log_path, 'r') as file:
-            lines = file.readlines()
 
-        for line in reversed(lines):
-            if 'Diff results' in line:
-                break
+def fingerprint_disks():
+    """
+    Fingerprint all data disks in parallel, one thread per disk. Returns
+    None if any disk could not be read, so the full diff runs instead.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        data_disks = read_data_disks(config["snapraid"]["config"])
+        ignore = set()
+        for path in read_content_files(config["snapraid"]["config"]):
+            ignore.update((path, path + ".tmp", path + ".lock"))
+        with ThreadPoolExecutor(max_workers=max(len(data_disks), 1)) as pool:
+            fingerprints = dict(zip(data_disks, pool.map(
+                lambda d: disk_fingerprint(d.rstrip("/") or "/", ignore),
+                data_disks.values())))
+    except OSError as e:
+        logging.warning("Could not fingerprint data disks, running full "
+                        "diff: {}".format(e))
+        return None
+    return fingerprints
 
-        result_regex = r"Diff results: (\d+) added,  (\d+) removed,  (\d+) moved,  (\d+) modified"
-        result_match = re.search(result_regex, line)
 
-        if result_match is None:
-            print("Couldn't find diff results in log file")
-            return
+def fastpath_unchanged(fingerprints):
+    """
+    Whether no data disk changed since the last successful sync, and that
+    sync's full diff is recent enough to trust the fingerprints
+    """
+    state = load_state(config["fastpath"]["statefile"]).get("fastpath", {})
+    max_age = config["fastpath"]["max-age"] * 86400
+    if not state or time.time() - state["full_diff"] > max_age:
+        return False
+    return state["fingerprints"] == fingerprints
+
+
+def save_fingerprints(fingerprints):
+    statefile = config["fastpath"]["statefile"]
+    state = load_state(statefile)
+    state["fastpath"] = {"fingerprints": fingerprints,
+                         "full_diff": time.time()}
+    save_state(statefile, state)
+
+
+def open_diff_index():
+    """ Open the configured diff index, or return None if it is disabled. """
+    if not config["diffindex"]["file"]:
+        return None
+    try:
+        data_disks = read_data_disks(config["snapraid"]["config"])
+    except OSError:
+        data_disks = {}
+    return DiffIndex(config["diffindex"]["file"], data_disks)
+
+
+def show_changes(change):
+    """ Print the changes recorded by the last run from the diff index. """
+    diff_index = open_diff_index()
+    if diff_index is None:
+        print("diff index is not enabled in the configuration")
+        sys.exit(2)
+    for change, path, disk, target in diff_index.changes(
+            None if change == "all" else change):
+        print("{} {}{}{}".format(
+            change, path, " -> " + target if target else "",
+            " [{}]".format(disk) if disk else ""))
+    diff_index.close()
+
+
+def write_json_report(run_summary, path):
+    import json
+    from homelab.metrics import write_atomic
+    report = {
+        "success": run_summary.success,
+        "start_time": run_summary.start_time,
+        "end_time": run_summary.end_time,
+        "duration": run_summary.duration,
+        "diff": run_summary.diff,
+        "phases": run_summary.phases,
+        "scrub": run_summary.scrub,
+        "error": run_summary.error,
+    }
+    write_atomic(path, json.dumps(report, indent=2) + "\n")
+
+
+def write_prometheus_metrics(run_summary, path):
+    """ Write the run summary for the node_exporter textfile collector. """
+    from homelab.metrics import prometheus_text, write_atomic
+    metrics = []
+
+    def metric(name, help_text, samples):
+        metrics.append(("snapraid_runner_" + name, help_text, samples))
+
+    phases = run_summary.phases.items()
+    metric("success", "Whether the last run succeeded.",
+           [({}, int(bool(run_summary.success)))])
+    metric("last_run_timestamp_seconds", "End time of the last run.",
+           [({}, run_summary.end_time)])
+    metric("duration_seconds", "Duration of the last run.",
+           [({}, run_summary.duration)])
+    metric("diff_files", "Files found changed by diff, by change type.",
+           [({"change": k}, v) for k, v in (run_summary.diff or {}).items()])
+    metric("phase_duration_seconds", "Duration of each snapraid command.",
+           [({"phase": k}, p["duration"]) for k, p in phases])
+    metric("phase_exit_code", "Exit code of each snapraid command.",
+           [({"phase": k}, p["returncode"]) for k, p in phases])
+    phase_metrics = [(k, p["metrics"]) for k, p in phases if "metrics" in p]
+    metric("phase_processed_megabytes", "Data processed by each command.",
+           [({"phase": k}, m["processed_mb"]) for k, m in phase_metrics])
+    metric("phase_speed_megabytes_per_second",
+           "Average and peak throughput reported by snapraid.",
+           [({"phase": k, "stat": stat}, m["speed_mb_s_" + stat])
+            for k, m in phase_metrics for stat in ("avg", "max")])
+    metric("phase_cpu_percent", "Average CPU usage reported by snapraid.",
+           [({"phase": k}, m["cpu_percent_avg"]) for k, m in phase_metrics])
+    metric("disk_wait_percent",
+           "Share of time snapraid spent waiting on each disk.",
+           [({"phase": k, "disk": disk}, wait) for k, m in phase_metrics
+            for disk, wait in m["disk_wait_percent"].items()])
+    scrub = run_summary.scrub or {"percent": None, "disks": {}}
+    metric("scrub_percent", "Share of the array scrubbed by the last run.",
+           [({}, scrub["percent"])])
+    metric("scrub_disk_percent",
+           "Share of each data disk scrubbed by the last run.",
+           [({"disk": disk}, percent)
+            for disk, percent in scrub["disks"].items()])
+    write_atomic(path, prometheus_text(metrics))
+
+
+def send_discord(success, run_summary):
+    from datetime import datetime
+    from zoneinfo import ZoneInfo
+    from homelab.notify import format_duration
+
+    url = config['discord']['webhook']
+    est = ZoneInfo('EST')
+    date_time = datetime.now(est)
 
+    if success:
         color = 0x0080d7
+        diff = run_summary.diff or dict.fromkeys(DiffCounter.change_types, 0)
         fields = [
-            {"name": "Added", "value": result_match.group(1), "inline": True},
-            {"name": "Removed", "value": result_match.group(2), "inline": True},
-            {"name": "Modified", "value": result_match.group(4), "inline": True},
+            {"name": "Added", "value": str(diff["add"]), "inline": True},
+            {"name": "Removed", "value": str(diff["remove"]), "inline": True},
+            {"name": "Modified", "value": str(diff["update"]), "inline": True},
             {
                 "name": "Duration",
-                "value": format_duration(duration),
+                "value": format_duration(run_summary.duration),
             },
             {
                 "name": "Time",
                 "value": date_time.strftime("%m/%d/%Y, %H:%M:%S %Z"),
             },
         ]
+        if run_summary.phases:
+            fields.insert(3, {
+                "name": "Phases",
+                "value": "\n".join(
+                    "{}: {}".format(name, format_duration(phase["duration"]))
+                    for name, phase in run_summary.phases.items()),
+            })
     else:
         color = 0xff0000
         status = "Failed"
@@ -136,9 +615,16 @@ def send_discord(success, exception_msg="", log_path=log_file_path, duration=0):
             },
             {
                 "name": "Exception message",
-                "value": f'```\n{exception_msg}\n```',
+                "value": f'```\n{run_summary.error[-1000:]}\n```',
             },
         ]
+        if run_summary.phases:
+            fields.insert(1, {
+                "name": "Exit codes",
+                "value": "\n".join(
+                    "{}: {}".format(name, phase["returncode"])
+                    for name, phase in run_summary.phases.items()),
+            })
 
     payload = {
         "embeds": [{
@@ -151,24 +637,65 @@ def send_discord(success, exception_msg="", log_path=log_file_path, duration=0):
         }]
     }
 
-    params = json.dumps(payload).encode('utf8')
-    headers = {
-        'content-type': 'application/json',
-        'user-agent': 'snapraid-runner/0.1'
-    }
+    # Sent in the background through the homelab outbox, so a failing
+    # webhook does not lose it
+    from homelab.notify import send_discord as queue_discord
+    queue_discord(url, payload["embeds"])
 
-    try:
-        req = urllib.request.Request(url, method="POST",
-                                     headers=headers)
-        res = urllib.request.urlopen(req, data=params)
-        res.read().decode('utf8')
-    except Exception as e:
-        print(e)
-
-def send_email(success):
+
+class EmailLogHandler(logging.Handler):
+    """
+    Log handler keeping the log for the email. Only the first and last
+    maxsize / 2 characters are kept, so memory use is capped from the
+    start; records falling out of the middle are counted instead.
+    A maxsize of 0 keeps everything.
+    """
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped_lines = 0
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + "\n"
+        except Exception:
+            self.handleError(record)
+            return
+        if not self.maxsize or (
+                not self.tail and
+                self.head_size + len(msg) <= self.maxsize // 2):
+            self.head.append(msg)
+            self.head_size += len(msg)
+            return
+        self.tail.append(msg)
+        self.tail_size += len(msg)
+        while self.tail_size > self.maxsize // 2 and len(self.tail) > 1:
+            dropped = self.tail.popleft()
+            self.tail_size -= len(dropped)
+            self.dropped_lines += dropped.count("\n")
+
+    def getvalue(self):
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        if not self.dropped_lines:
+            return head + tail
+        return (
+            "NOTE: Log was too big for email and was shortened\n\n" +
+            head +
+            "[...]\n\n\n --- LOG WAS TOO BIG - {} LINES REMOVED --\n\n\n[...]".format(
+                self.dropped_lines) +
+            tail)
+
+
+def send_email(success, run_summary):
     import smtplib
     from email.mime.text import MIMEText
     from email import charset
+    from homelab.notify import format_duration
 
     if len(config["smtp"]["host"]) == 0:
         logging.error("Failed to send email because smtp host is not set")
@@ -180,17 +707,16 @@ def send_email(success):
         body = "SnapRAID job completed successfully:\n\n\n"
     else:
         body = "Error during SnapRAID job:\n\n\n"
+    if run_summary.diff is not None:
+        body += ("Diff results: {add} added,  {remove} removed,  " +
+                 "{move} moved,  {update} modified\n").format(
+                     **run_summary.diff)
+    for name, phase in run_summary.phases.items():
+        body += "{}: exit code {} after {}\n".format(
+            name, phase["returncode"], format_duration(phase["duration"]))
+    body += "\n\n"
 
     log = email_log.getvalue()
-    maxsize = config['email'].get('maxsize', 500) * 1024
-    if maxsize and len(log) > maxsize:
-        cut_lines = log.count("\n", maxsize // 2, -maxsize // 2)
-        log = (
-            "NOTE: Log was too big for email and was shortened\n\n" +
-            log[:maxsize // 2] +
-            "[...]\n\n\n --- LOG WAS TOO BIG - {} LINES REMOVED --\n\n\n[...]".format(
-                cut_lines) +
-            log[-maxsize // 2:])
     body += log
 
     msg = MIMEText(body, "plain", "utf-8")
@@ -217,13 +743,22 @@ def send_email(success):
 
 
 def finish(is_success):
+    summary.end_time = time.time()
+    summary.success = is_success
+    try:
+        if config["metrics"]["report"]:
+            write_json_report(summary, config["metrics"]["report"])
+        if config["metrics"]["prometheus"]:
+            write_prometheus_metrics(summary, config["metrics"]["prometheus"])
+    except Exception:
+        logging.exception("Failed to write run report")
     if ("error", "success")[is_success] in config["email"]["sendon"]:
         try:
             if config['smtp']['enabled']:
-                send_email(is_success)
+                send_email(is_success, summary)
 
             if config['discord']['enabled']:
-                send_discord(is_success)
+                send_discord(is_success, summary)
         except Exception:
             logging.exception("Failed to send email")
     if is_success:
@@ -234,10 +769,12 @@ def finish(is_success):
 
 
 def load_config(args):
+    import configparser
     global config
     parser = configparser.RawConfigParser()
     parser.read(args.conf)
-    sections = ["snapraid", "logging", "email", "smtp", "scrub", "discord", "sync"]
+    sections = ["snapraid", "logging", "email", "smtp", "scrub", "discord",
+                "sync", "diffindex", "metrics", "fastpath", "retry"]
     config = dict((x, defaultdict(lambda: "")) for x in sections)
     for section in parser.sections():
         for (k, v) in parser.items(section):
@@ -245,7 +782,9 @@ def load_config(args):
 
     int_options = [
         ("snapraid", "deletethreshold"), ("logging", "maxsize"),
-        ("scrub", "older-than"), ("email", "maxsize"),
+        ("scrub", "older-than"), ("scrub", "window"), ("email", "maxsize"),
+        ("diffindex", "keep"), ("fastpath", "max-age"),
+        ("retry", "attempts"), ("retry", "delay"), ("retry", "max-delay"),
     ]
     for section, option in int_options:
         try:
@@ -261,11 +800,18 @@ def load_config(args):
     config["email"]["short"] = (config["email"]["short"].lower() == "true")
     config["snapraid"]["touch"] = (config["snapraid"]["touch"].lower() == "true")
     config["sync"]["force-zero"] = (config["sync"]["force-zero"].lower() == "true")
+    config["metrics"]["progress"] = (config["metrics"]["progress"].lower() == "true")
+    config["fastpath"]["enabled"] = (config["fastpath"]["enabled"].lower() == "true")
 
     # Migration
     if config["scrub"]["percentage"]:
         config["scrub"]["plan"] = config["scrub"]["percentage"]
 
+    if config["scrub"]["window"] and not config["scrub"]["statefile"]:
+        raise ValueError("scrub.statefile must be set to use scrub.window")
+    if config["fastpath"]["enabled"] and not config["fastpath"]["statefile"]:
+        raise ValueError("fastpath.statefile must be set to enable fastpath")
+
     if args.scrub is not None:
         config["scrub"]["enabled"] = args.scrub
 
@@ -277,18 +823,17 @@ def setup_logger():
     log_format = logging.Formatter(
         "%(asctime)s [%(levelname)-6.6s] %(message)s")
     root_logger = logging.getLogger()
-    logging.OUTPUT = 15
-    logging.addLevelName(logging.OUTPUT, "OUTPUT")
-    logging.OUTERR = 25
-    logging.addLevelName(logging.OUTERR, "OUTERR")
-    root_logger.setLevel(logging.OUTPUT)
+    logging.addLevelName(OUTPUT, "OUTPUT")
+    logging.addLevelName(OUTERR, "OUTERR")
+    root_logger.setLevel(OUTPUT)
     console_logger = logging.StreamHandler(sys.stdout)
     console_logger.setFormatter(log_format)
     root_logger.addHandler(console_logger)
 
     if config["logging"]["file"]:
         max_log_size = max(config["logging"]["maxsize"], 0) * 1024
-        file_logger = logging.handlers.RotatingFileHandler(
+        from logging.handlers import RotatingFileHandler
+        file_logger = RotatingFileHandler(
             config["logging"]["file"],
             maxBytes=max_log_size,
             backupCount=9)
@@ -297,16 +842,17 @@ def setup_logger():
 
     if config["email"]["sendon"]:
         global email_log
-        email_log = StringIO()
-        email_logger = logging.StreamHandler(email_log)
-        email_logger.setFormatter(log_format)
+        email_log = EmailLogHandler(config["email"]["maxsize"] * 1024)
+        email_log.setFormatter(log_format)
         if config["email"]["short"]:
             # Don't send programm stdout in email
-            email_logger.setLevel(logging.INFO)
-        root_logger.addHandler(email_logger)
+            email_log.setLevel(logging.INFO)
+        root_logger.addHandler(email_log)
 
 
 def main():
+    import argparse
+    import traceback
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--conf",
                         default="snapraid-runner.conf",
@@ -317,6 +863,11 @@ def main():
                         help="Do not scrub (overrides config)")
     parser.add_argument("--ignore-deletethreshold", action='store_true',
                         help="Sync even if configured delete threshold is exceeded")
+    parser.add_argument("--show-changes", metavar="TYPE",
+                        choices=DiffIndex.change_types + ("all",),
+                        help="Print the changes of TYPE (one of %(choices)s) "
+                             "found by the last run from the diff index "
+                             "and exit")
     args = parser.parse_args()
 
     if not os.path.exists(args.conf):
@@ -331,6 +882,10 @@ def main():
         print(traceback.format_exc())
         sys.exit(2)
 
+    if args.show_changes:
+        show_changes(args.show_changes)
+        sys.exit(0)
+
     try:
         setup_logger()
     except Exception:
@@ -338,55 +893,114 @@ def main():
         print(traceback.format_exc())
         sys.exit(2)
 
-    while True:
+    global summary
+    summary = RunSummary()
+
+    if config["snapraid"]["lockfile"]:
         try:
-            run()
-            break  # if the run succeeds, break out of the loop
-        except Exception:
+            lock_runner(config["snapraid"]["lockfile"])
+        except BlockingIOError:
+            summary.error = ("Another snapraid-runner holds {}, not "
+                             "starting".format(config["snapraid"]["lockfile"]))
+            logging.error(summary.error)
+            finish(False)
+
+    supervise(run)
+    finish(True)
+
+
+def supervise(job):
+    """
+    Run job, retrying it with exponential backoff as long as it fails with
+    transient errors and retry.attempts is not used up. Any other error
+    ends the run.
+    """
+    import subprocess
+    import traceback
+    attempts = max(config["retry"]["attempts"], 1)
+    for attempt in range(1, attempts + 1):
+        try:
+            job()
+            return
+        except RunnerError as e:
+            logging.error(e)
+            summary.error = str(e)
+            finish(False)
+        except subprocess.CalledProcessError as e:
+            logging.error(e)
+            summary.error = "{}\n{}".format(e, e.stderr or "").strip()
+            transient = is_transient(e.stderr or "")
+        except Exception as e:
             logging.exception("Run failed due to unexpected exception:")
+            summary.error = traceback.format_exc()
+            transient = is_transient(str(e))
+        if not transient or attempt == attempts:
             finish(False)
+        delay = min(config["retry"]["delay"] * 2 ** (attempt - 1),
+                    config["retry"]["max-delay"] or float("inf"))
+        logging.warning(
+            "Transient error, retrying in {} seconds (attempt {} of {})".format(
+                delay, attempt + 1, attempts))
+        time.sleep(delay)
 
-            time.sleep(300)  # wait for 5 minutes before trying again
 
-    finish(True)
+class RunnerError(Exception):
+    """ A run failed for a reason that retrying will not fix. """
 
-def run():
-    logging.info("=" * 60)
-    logging.info("Run started")
-    logging.info("=" * 60)
 
-    if not os.path.isfile(config["snapraid"]["executable"]):
-        logging.error("The configured snapraid executable \"{}\" does not "
-                      "exist or is not a file".format(
-                          config["snapraid"]["executable"]))
-        finish(False)
-    if not os.path.isfile(config["snapraid"]["config"]):
-        logging.error("Snapraid config does not exist at " +
-                      config["snapraid"]["config"])
-        finish(False)
+def is_transient(error_text):
+    """
+    Whether an error looks like it will go away by itself, such as another
+    snapraid process holding the array lock or a busy disk
+    """
+    return re.search(TRANSIENT_ERROR, error_text) is not None
+
 
+def lock_runner(path):
+    """
+    Take an exclusive lock on path for the lifetime of the process, so
+    overlapping runs do not start snapraid processes fighting over the
+    content files. Raises BlockingIOError if another run holds it.
+    """
+    import fcntl
+    global lock_file
+    lock_file = open(path, "a+")
+    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    lock_file.truncate(0)
+    lock_file.write("{}\n".format(os.getpid()))
+    lock_file.flush()
+
+
+def sync_array():
+    """ Run touch and diff, then sync if anything changed. """
     if config["snapraid"]["touch"]:
         logging.info("Running touch...")
-        snapraid_command("touch")
+        snapraid_command("touch", line_handlers=[])
         logging.info("*" * 60)
 
     logging.info("Running diff...")
-    diff_out = snapraid_command("diff", allow_statuscodes=[2])
+    diff_counter = DiffCounter()
+    diff_handlers = [diff_counter]
+    diff_index = open_diff_index()
+    if diff_index is not None:
+        diff_index.start_run()
+        diff_handlers.append(diff_index)
+    snapraid_command("diff", allow_statuscodes=[2],
+                     line_handlers=diff_handlers)
+    if diff_index is not None:
+        diff_index.finish_run(config["diffindex"]["keep"])
     logging.info("*" * 60)
 
-    diff_results = Counter(line.split(" ")[0] for line in diff_out)
-    diff_results = dict((x, diff_results[x]) for x in
-                        ["add", "remove", "move", "update"])
+    diff_results = summary.diff = diff_counter.counts
     logging.info(("Diff results: {add} added,  {remove} removed,  " +
                   "{move} moved,  {update} modified").format(**diff_results))
 
     if (config["snapraid"]["deletethreshold"] >= 0 and
             diff_results["remove"] > config["snapraid"]["deletethreshold"]):
-        logging.error(
-            "Deleted files exceed delete threshold of {}, aborting".format(
+        raise RunnerError(
+            "Deleted files exceed delete threshold of {}, aborting. Run "
+            "again with --ignore-deletethreshold to sync anyways".format(
                 config["snapraid"]["deletethreshold"]))
-        logging.error("Run again with --ignore-deletethreshold to sync anyways")
-        finish(False)
 
     if (diff_results["remove"] + diff_results["add"] + diff_results["move"] +
             diff_results["update"] == 0):
@@ -396,40 +1010,68 @@ def run():
         sync_args: dict[str, str] = {}
         if config["sync"]["force-zero"]:
             sync_args["force-zero"] = ""
-        try:
-            snapraid_command("sync", sync_args)
-        except subprocess.CalledProcessError as e:
-            logging.error(e)
-            finish(False)
+        snapraid_command("sync", sync_args, line_handlers=[])
+        if diff_index is not None:
+            diff_index.mark_synced()
         logging.info("*" * 60)
 
+
+def run():
+    logging.info("=" * 60)
+    logging.info("Run started")
+    logging.info("=" * 60)
+
+    if not os.path.isfile(config["snapraid"]["executable"]):
+        raise RunnerError("The configured snapraid executable \"{}\" does "
+                          "not exist or is not a file".format(
+                              config["snapraid"]["executable"]))
+    if not os.path.isfile(config["snapraid"]["config"]):
+        raise RunnerError("Snapraid config does not exist at " +
+                          config["snapraid"]["config"])
+
+    fingerprints = None
+    if config["fastpath"]["enabled"]:
+        fingerprints = fingerprint_disks()
+    if fingerprints is not None and fastpath_unchanged(fingerprints):
+        logging.info("No data disk changed since the last sync, skipping "
+                     "touch, diff and sync")
+        summary.diff = dict.fromkeys(DiffCounter.change_types, 0)
+        logging.info("*" * 60)
+    else:
+        sync_array()
+        if fingerprints is not None:
+            save_fingerprints(fingerprints)
+
     if config["scrub"]["enabled"]:
         logging.info("Running scrub...")
         try:
             # Check if a percentage plan was given
-            int(config["scrub"]["plan"])
+            percentage = int(config["scrub"]["plan"])
         except ValueError:
+            percentage = None
             scrub_args = {"plan": config["scrub"]["plan"]}
         else:
+            percentage = scrub_percentage(percentage)
             scrub_args = {
-                "plan": config["scrub"]["plan"],
+                "plan": percentage,
                 "older-than": config["scrub"]["older-than"],
             }
-        try:
-            snapraid_command("scrub", scrub_args)
-        except subprocess.CalledProcessError as e:
-            logging.error(e)
-            finish(False)
+        started = time.monotonic()
+        snapraid_command("scrub", scrub_args, line_handlers=[])
+        if percentage is not None:
+            if config["scrub"]["window"]:
+                save_scrub_speed(percentage, time.monotonic() - started)
+            # Scrub works on whole stripes, which span every data disk
+            try:
+                data_disks = read_data_disks(config["snapraid"]["config"])
+            except OSError:
+                data_disks = {}
+            summary.scrub = {"percent": percentage,
+                             "disks": dict.fromkeys(data_disks, percentage)}
         logging.info("*" * 60)
 
     logging.info("All done")
-    finish(True)
-
 
-main()
-if not success:
-    exception_msg = traceback.format_exc()[-2000:]
-    send_discord(False, exception_msg)
-else:
-    send_discord(True)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Tests for the Discord outbox of homelab.notify against a stub webhook on
+127.0.0.1. Run with python3 -m pytest tests or python3 -m unittest.
+"""
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from homelab.notify import STALE_TMP_AGE, DiscordDispatcher  # noqa: E402
+
+# A script queueing one message and exiting, which sends it at exit
+SEND_AND_EXIT = """
+import sys
+from homelab.notify import send_discord
+send_discord(sys.argv[1], [{"title": sys.argv[2]}])
+"""
+
+
+class StubWebhook:
+    """
+    A webhook answering with the (status, headers, body) of responses in
+    turn, the last one for every request after that. Records the times and
+    payloads of the requests it gets.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stub.requests.append((time.monotonic(), json.loads(body)))
+                status, headers, data = (stub.responses.pop(0)
+                                         if len(stub.responses) > 1
+                                         else stub.responses[0])
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/webhook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+NO_CONTENT = (204, {}, b"")
+
+
+def embed(n):
+    return {"title": f"message {n}"}
+
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outbox = os.path.join(self.tmp.name, "outbox")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dispatcher(self, **kwargs):
+        kwargs.setdefault("linger", 0.2)
+        return DiscordDispatcher(self.outbox, timeout=5, **kwargs)
+
+    def webhook(self, *responses):
+        webhook = StubWebhook(responses)
+        self.addCleanup(webhook.close)
+        return webhook
+
+    def queued(self):
+        return [name for name in os.listdir(self.outbox)
+                if name.startswith(tuple("0123456789"))]
+
+    def test_messages_are_batched(self):
+        webhook = self.webhook(NO_CONTENT)
+        dispatcher = self.dispatcher()
+        for n in range(12):
+            dispatcher.send(webhook.url, [embed(n)])
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual([len(payload["embeds"])
+                          for _, payload in webhook.requests], [10, 2])
+        self.assertEqual([e["title"] for _, payload in webhook.requests
+                          for e in payload["embeds"]],
+                         [f"message {n}" for n in range(12)])
+        self.assertEqual(self.queued(), [])
+
+    def test_rate_limit_waits_retry_after(self):
+        webhook = self.webhook(
+            (429, {"Content-Type": "application/json"},
+             json.dumps({"retry_after": 1.5}).encode()),
+            NO_CONTENT)
+        dispatcher = self.dispatcher()
+        dispatcher.send(webhook.url, [embed(1)])
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual(len(webhook.requests), 2)
+        self.assertGreaterEqual(
+            webhook.requests[1][0] - webhook.requests[0][0], 1.5)
+        self.assertEqual(webhook.requests[0][1], webhook.requests[1][1])
+        self.assertEqual(self.queued(), [])
+
+    def test_rate_limits_count_as_attempts(self):
+        webhook = self.webhook(
+            (429, {"Content-Type": "application/json"},
+             json.dumps({"retry_after": 0.1}).encode()))
+        dispatcher = self.dispatcher(max_attempts=3)
+        dispatcher.send(webhook.url, [embed(1)])
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual(len(webhook.requests), 3)
+        self.assertEqual(len(self.queued()), 1)
+
+    def test_unreachable_webhook_keeps_message_in_outbox(self):
+        webhook = self.webhook((500, {}, b"down"))
+        dispatcher = self.dispatcher(max_attempts=2)
+        dispatcher.send(webhook.url, [embed(1)])
+        self.assertTrue(dispatcher.flush(15))
+        self.assertEqual(len(webhook.requests), 2)
+        queued = self.queued()
+        self.assertEqual(len(queued), 1)
+        self.assertTrue(queued[0].endswith(".json"))
+        with open(os.path.join(self.outbox, queued[0])) as f:
+            self.assertEqual(json.load(f),
+                             {"url": webhook.url, "embed": embed(1)})
+
+    def test_rejected_message_moves_to_failed(self):
+        webhook = self.webhook((400, {}, b"bad embed"))
+        dispatcher = self.dispatcher()
+        dispatcher.send(webhook.url, [embed(1)])
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(len(os.listdir(os.path.join(self.outbox, "failed"))),
+                         1)
+
+    def test_outbox_is_private(self):
+        webhook = self.webhook((500, {}, b"down"))
+        dispatcher = self.dispatcher(max_attempts=1)
+        dispatcher.send(webhook.url, [embed(1)])
+        self.assertTrue(dispatcher.flush(10))
+        for directory in (self.outbox, os.path.join(self.outbox, "failed")):
+            self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+        for name in self.queued():
+            self.assertEqual(stat.S_IMODE(
+                os.stat(os.path.join(self.outbox, name)).st_mode), 0o600)
+
+    def test_stale_tmp_files_are_removed(self):
+        os.makedirs(self.outbox)
+        stale = os.path.join(self.outbox, "1-1-0.json.tmp")
+        fresh = os.path.join(self.outbox, "2-1-0.json.tmp")
+        for path in (stale, fresh):
+            open(path, "w").close()
+        old = time.time() - STALE_TMP_AGE - 60
+        os.utime(stale, (old, old))
+        self.dispatcher()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_processes_send_their_own_messages(self):
+        webhook = self.webhook(NO_CONTENT)
+        env = dict(os.environ, HOMELAB_OUTBOX=self.outbox, PYTHONPATH=ROOT)
+        started = time.monotonic()
+        processes = [subprocess.Popen(
+            [sys.executable, "-c", SEND_AND_EXIT, webhook.url, f"message {n}"],
+            env=env) for n in range(2)]
+        for process in processes:
+            self.assertEqual(process.wait(20), 0)
+        # Neither waits out the 30 second flush for a message the other sent
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(sorted(e["title"] for _, payload in webhook.requests
+                                for e in payload["embeds"]),
+                         ["message 0", "message 1"])
+        self.assertEqual(self.queued(), [])
+
+    def test_messages_of_exited_processes_are_sent(self):
+        webhook = self.webhook(NO_CONTENT)
+        os.makedirs(self.outbox)
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        name = f"{time.time_ns()}-{process.pid}-0.json"
+        with open(os.path.join(self.outbox, name), "w") as f:
+            json.dump({"url": webhook.url, "embed": embed(1)}, f)
+        self.dispatcher()
+        deadline = time.monotonic() + 10
+        while self.queued() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(self.queued(), [])
+        self.assertEqual(len(webhook.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,22 @@
 import os
 import tarfile
-from shutil import copytree, ignore_patterns, make_archive, move, rmtreee
+import tempfile
+from contextlib import contextmanager
+from fnmatch import fnmatch
 from pathlib import Path
-import sqlite3
 from datetime import datetime
 from tqdm import tqdm
 from pytz import timezone
-import requests
 import configparser
 import paramiko
+import sys
+
+# Notifications go through the shared homelab package in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homelab.archive import exclude, gpg_encrypt  # noqa: E402
+from homelab.compress import FORMATS, compress, compressor  # noqa: E402
+from homelab.database import backup_database  # noqa: E402
+from homelab.notify import send_discord  # noqa: E402
 
 webhook_url = "https://discord.com/api/webhooks/<embed>"
 
@@ -17,97 +25,137 @@ config = configparser.ConfigParser()
 config.read('/root/.secrets/warden.ini')
 password = config['Vaultwarden']['password']
 
+# The names backups are written under, the only files expire deletes: one
+# per compression format, and the 7z encrypted backups of older versions
+# (named .tar.tar.bz2.enc by with_suffix)
+BACKUP_PATTERNS = [f"backup-vaultwarden-??-??-????.tar{extension}.gpg"
+                   for extension, _, _, _ in FORMATS.values()]
+BACKUP_PATTERNS.append("backup-vaultwarden-??-??-????.tar.tar.bz2.enc")
+
 class Backup:
+    """
+    Make a backup of a vaultwarden installation on a remote host.
+
+    The data directory and a snapshot of the database are tarred, compressed
+    and encrypted with gpg while they are streamed over SFTP, so
+    nothing but the database snapshot is written to local disk.
+    compression picks the format ("auto", "zstd", "xz", "gzip", "bzip2" or
+    "none"), done by the fastest installed tool with compression_threads
+    threads (0 for all cores). Restore a .tar.zst.gpg with:
+    gpg -d backup-vaultwarden-<date>.tar.zst.gpg | tar -x --zstd
+    """
     def __init__(self,
                  datadir="/opt/bitwarden",
-                 debug=True):
+                 debug=True,
+                 db_pages_per_step=-1,
+                 db_vacuum=False,
+                 compression="auto",
+                 compression_level=None,
+                 compression_threads=0,
+                 remote_host="<IP ADDRESS",
+                 remote_username="<USER>",
+                 remote_private_key_path="/home/<USER>/.ssh/id_rsa",  # Replace with the path to your private key
+                 remote_path="/path/to/Vaultwarden"):
 
         self.now = datetime.now().strftime("%m-%d-%Y")
 
         self.debug = debug
+        self.db_pages_per_step = db_pages_per_step
+        self.db_vacuum = db_vacuum
+        self.compressor = compressor(compression, compression_level,
+                                     compression_threads)
         self.datadir = Path(datadir)
-        self.stagedir = None
-
-    def make_staging(self):
-        """ Create the staging directory in /tmp. """
-        self.stagedir = Path("/tmp") / f"backup-{self.now}"
-        if self.stagedir.exists():
-            if self.debug:
-                print(f"Removing existing staging {self.stagedir}.")
-            rmtree(self.stagedir, ignore_errors=False)
-        if self.debug:
-            print(f"Making staging {self.stagedir}")
-        self.stagedir.mkdir(parents=True)
-
-    def cleanup_staging(self):
-        """ Remove the staging directory if it exists. """
-        if self.stagedir is not None and self.stagedir.exists():
-            if self.debug:
-                print(f"Remove staging {self.stagedir}.")
-            rmtree(self.stagedir, ignore_errors=False)
-
-    def backup_db(self):
-        """ Make a backup of the sqlite3 database separately, using the iterdump() method for database backups. """
-
+        self.remote_host = remote_host
+        self.remote_username = remote_username
+        self.remote_private_key_path = remote_private_key_path
+        self.remote_path = remote_path
+
+    def backup_db(self, backup_dbfile):
+        """
+        Copy the sqlite3 database with SQLite's online backup API, page by
+        page. The copy is consistent even while vaultwarden writes to the
+        database, and is checked with integrity_check.
+        """
         data_dbfile = self.datadir / "db.sqlite3"
-        backup_dbfile = self.stagedir / "db.sqlite3"
-
-        timeout_seconds = 30  # Adjust the timeout value as needed
-
-        with sqlite3.connect(str(data_dbfile), timeout=timeout_seconds) as con, \
-                sqlite3.connect(str(backup_dbfile), timeout=timeout_seconds) as backup_con:
-            dump_gen = con.iterdump()
-            dump_gen_list = list(dump_gen)
-            total_commands = len(dump_gen_list)
 
-            with tqdm(total=total_commands, desc="Backing up database", unit=" commands") as progress_bar:
-                for command in dump_gen_list:
-                    if command.strip().lower() != "commit;":
-                        with backup_con:
-                            backup_con.executescript(command)
-                    progress_bar.update(1)
+        with tqdm(desc="Backing up database", unit=" pages") as progress_bar:
+            def progress(copied, total):
+                progress_bar.total = total
+                progress_bar.update(copied - progress_bar.n)
 
-    def backup_everything_else(self):
-        """ Using copytree(), we make a copy of all things except the database and the staging directory. """
+            result = backup_database(str(data_dbfile), str(backup_dbfile),
+                                     self.db_pages_per_step, progress,
+                                     vacuum=self.db_vacuum)
         if self.debug:
-            print(f"Copy files from {self.datadir} to {self.stagedir}.")
-        copytree(self.datadir, self.stagedir, dirs_exist_ok=True, ignore=ignore_patterns('db.sqlite3*', 'staging'))
-
-    def get_backup_filename(self):
-        return f"backup-vaultwarden-{self.now}.tar.bz2"
-
-    def backup_bztar(self):
-        """ Compress the staging directory into a .tar.bz2 and move to backupdir. """
+            print(f"Copied {result['pages']} pages of the database in "
+                  f"{result['seconds']:.1f}s, {result['bytes']} bytes.")
+
+    def write_archive(self, output):
+        """
+        Write the encrypted archive of the data directory and the database
+        snapshot to output. Returns the CompressStream with the compression
+        ratio and rate.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_copy = Path(tmpdir) / "db.sqlite3"
+            self.backup_db(db_copy)
+            if self.debug:
+                print(f"Archive {self.datadir}.")
+            with gpg_encrypt(output, password) as encrypted, \
+                    compress(encrypted, self.compressor) as stream, \
+                    tarfile.open(fileobj=stream, mode="w|",
+                                 copybufsize=1 << 20) as tar:
+                tar.add(self.datadir, arcname=".",
+                        filter=exclude(["db.sqlite3*", "staging"]))
+                tar.add(db_copy, arcname="./db.sqlite3")
         if self.debug:
-            print(f"Archive {self.stagedir} into {self.stagedir}.tar.bz2.")
-
-        tar_filename = f"{self.stagedir.parent}/{self.stagedir.name}.tar.bz2"
-        make_archive(str(self.stagedir.parent / self.stagedir.name), "bztar", self.stagedir)
-        move(tar_filename, self.stagedir / self.get_backup_filename())  # Use get_backup_filename method
-
-    def send_backup_via_ssh(self, backup_file_path, remote_host, remote_username, remote_private_key_path, remote_path):
-        private_key = paramiko.RSAKey(filename=remote_private_key_path)
-        transport = paramiko.Transport((remote_host, 22))
-        transport.connect(username=remote_username, pkey=private_key)
+            print(f"Compressed with {stream.summary()}.")
+        return stream
 
-        sftp = paramiko.SFTPClient.from_transport(transport)
-        remote_file_path = remote_path + "/" + backup_file_path.name
+    def get_backup_filename(self):
+        return f"backup-vaultwarden-{self.now}.tar{self.compressor.extension}.gpg"
 
+    @contextmanager
+    def sftp(self):
+        """ An SFTP session to the remote host. """
+        private_key = paramiko.RSAKey(filename=self.remote_private_key_path)
+        transport = paramiko.Transport((self.remote_host, 22))
         try:
-            sftp.put(str(backup_file_path), remote_file_path)
-            print(f"Backup file {backup_file_path.name} sent to {remote_host}:{remote_file_path}")
-        except Exception as e:
-            print(f"Failed to send backup file: {e}")
+            transport.connect(username=self.remote_username, pkey=private_key)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            try:
+                yield sftp
+            finally:
+                sftp.close()
         finally:
-            sftp.close()
             transport.close()
 
-    def send_discord_message(self, filename, success=True, error_output=None):
+    def send_backup_via_ssh(self):
+        """
+        Stream the encrypted archive to remote_path. It is written under a
+        .partial name and renamed once complete, so an interrupted transfer
+        never looks like a backup. Returns the CompressStream.
+        """
+        remote_file_path = f"{self.remote_path}/{self.get_backup_filename()}"
+        partial_path = remote_file_path + ".partial"
+        with self.sftp() as sftp:
+            try:
+                with sftp.open(partial_path, "wb") as output:
+                    # Don't wait for the server to acknowledge every write
+                    output.set_pipelined(True)
+                    stream = self.write_archive(output)
+                sftp.posix_rename(partial_path, remote_file_path)
+            except Exception:
+                try:
+                    sftp.remove(partial_path)
+                except OSError:
+                    pass
+                raise
+        print(f"Backup file {self.get_backup_filename()} sent to {self.remote_host}:{remote_file_path}")
+        return stream
+
+    def send_discord_message(self, filename, success=True, error_output=None, compression=None):
         """ Sends a Discord message via webhook with information about the backup. """
-        headers = {
-            "Content-Type": "application/json"
-        }
-
         if success:
             now = datetime.now(timezone('US/Eastern')).strftime(
                 "%m/%d/%Y %I:%M:%S %p %Z")
@@ -127,6 +175,11 @@ class Backup:
                     "color": 3066993
                 }]
             }
+            if compression is not None:
+                embed_data["embeds"][0]["fields"].append({
+                    "name": "Compression",
+                    "value": compression.summary()
+                })
         else:
             embed_data = {
                 "embeds": [{
@@ -136,57 +189,36 @@ class Backup:
                 }]
             }
 
-        response = requests.post(webhook_url, headers=headers, json=embed_data)
-        if response.status_code != 204:
-            print(f"Failed to send Discord message: {response.text}")
+        send_discord(webhook_url, embed_data["embeds"])
 
     def backup(self):
         try:
-            self.make_staging()
-            self.backup_everything_else()
-            self.backup_db()
-            self.backup_bztar()
-
-            # Encrypt the tar file
-            tar_file = self.stagedir / self.get_backup_filename()
-            encrypted_tar_file = tar_file.with_suffix('.tar.bz2.enc')
-            os.system(f'7z a -p{password} -y {encrypted_tar_file} {tar_file}')
-            os.remove(tar_file)
-
-            # Transfer the encrypted tar file via SSH
-            remote_private_key_path = "/home/<USER>/.ssh/id_rsa"  # Replace with the path to your private key
-            backup_file = encrypted_tar_file
-            self.send_backup_via_ssh(
-                backup_file,
-                remote_host="<IP ADDRESS",
-                remote_username="<USER>",
-                remote_private_key_path=remote_private_key_path,
-                remote_path="/path/to/Vaultwarden"
-            )
+            stream = self.send_backup_via_ssh()
 
             # Send Discord webhook notification
-            self.send_discord_message(encrypted_tar_file.name)
-
-            self.cleanup_staging()
+            self.send_discord_message(self.get_backup_filename(), compression=stream)
         except Exception as e:
             error_output = str(e)
             self.send_discord_message(None, success=False, error_output=error_output)
             raise
 
     def expire(self, max_backups=5):
-        """ Expire Backups older than the most recent max_backups (default: 5). """
-        backup_files = list(self.stagedir.glob("*.tar.bz2.enc"))
-        backup_files.sort(key=lambda p: p.stat().st_ctime, reverse=True)
-
-        for idx, p in enumerate(backup_files):
-            if idx >= max_backups:
-                if self.debug:
-                    print(f"Expire file {p} (index: {idx}).")
-                p.unlink()
-            else:
-                if self.debug:
-                    print(f"File {p} still good (index: {idx}).")
-
+        """ Expire remote backups older than the most recent max_backups (default: 5). """
+        with self.sftp() as sftp:
+            backup_files = [a for a in sftp.listdir_attr(self.remote_path)
+                            if any(fnmatch(a.filename, pattern)
+                                   for pattern in BACKUP_PATTERNS)]
+            backup_files.sort(key=lambda a: a.st_mtime, reverse=True)
+
+            for idx, a in enumerate(backup_files):
+                p = f"{self.remote_path}/{a.filename}"
+                if idx >= max_backups:
+                    if self.debug:
+                        print(f"Expire file {p} (index: {idx}).")
+                    sftp.remove(p)
+                else:
+                    if self.debug:
+                        print(f"File {p} still good (index: {idx}).")
 
 b = Backup()
 b.backup()
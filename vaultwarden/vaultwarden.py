@@ -2,13 +2,20 @@
 
 from pathlib import Path
 from datetime import datetime
-import requests
 from pytz import timezone
-import sqlite3
 from tqdm import tqdm
-from shutil import copytree, ignore_patterns, make_archive, rmtree, move
 import configparser
 import os
+import sys
+import tarfile
+import tempfile
+
+# Notifications go through the shared homelab package in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from homelab.archive import exclude, gpg_encrypt  # noqa: E402
+from homelab.compress import FORMATS, compress, compressor  # noqa: E402
+from homelab.database import backup_database  # noqa: E402
+from homelab.notify import send_discord  # noqa: E402
 
 webhook_url = 'https://discord.com/api/webhooks/<embed>'
 
@@ -17,91 +24,100 @@ config = configparser.ConfigParser()
 config.read('/root/.secrets/warden.ini')
 password = config['Vaultwarden']['password']
 
+# The names backups are written under, the only files expire deletes: one
+# per compression format, and the 7z encrypted backups of older versions
+# (named .tar.tar.bz2.enc by with_suffix)
+BACKUP_PATTERNS = [f"backup-vaultwarden-??-??-????.tar{extension}.gpg"
+                   for extension, _, _, _ in FORMATS.values()]
+BACKUP_PATTERNS.append("backup-vaultwarden-??-??-????.tar.tar.bz2.enc")
+
 class Backup:
     """
     Make a backup of a vaultwarden installation.
 
-    We create a backups directory, in which we create a staging subdirectory.
-    Files are copied into the stage, according to the instructions in
-    https://github.com/dani-garcia/vaultwarden/wiki/Backing-up-your-vault.
-    The stage is then archived into a .tar.bz2, and removed.
+    The data directory is archived according to the instructions in
+    https://github.com/dani-garcia/vaultwarden/wiki/Backing-up-your-vault,
+    with a snapshot of the database in place of the live one. The archive is
+    streamed through a compressor and gpg straight into the backup file, so the data
+    is read once and nothing but the database snapshot is staged on disk.
+    compression picks the format ("auto", "zstd", "xz", "gzip", "bzip2" or
+    "none"), done by the fastest installed tool with compression_threads
+    threads (0 for all cores). Restore a .tar.zst.gpg with:
+    gpg -d backup-vaultwarden-<date>.tar.zst.gpg | tar -x --zstd
     """
     def __init__(self,
                  datadir="/path/to/vaultwarden",
                  backupdir="/path/to/backup/Vaultwarden",
-                 debug=True):
+                 debug=True,
+                 db_pages_per_step=-1,
+                 db_vacuum=False,
+                 compression="auto",
+                 compression_level=None,
+                 compression_threads=0):
         """ Constructor.
         datadir: Location of the vaultwarden installation. Must be readable to the program.
-        backupdir: Location where the staging subdirectory will be created. Later the .tar.bz2 will be left here.
-            The staging directory will be {backupdir}/backup-{now}.
+        backupdir: Location where the encrypted archive, backup-vaultwarden-<date>.tar.<compression>.gpg (e.g. .tar.zst.gpg), will be written.
         debug: prints some messages when set to True (Default: False).
+        db_pages_per_step: database pages copied at a time, -1 for all at once (Default: -1). WAL databases are always copied at once.
+        db_vacuum: compact the database copy with VACUUM INTO (Default: False).
         """
         self.now = datetime.now().strftime("%m-%d-%Y")
 
         self.debug = debug
+        self.db_pages_per_step = db_pages_per_step
+        self.db_vacuum = db_vacuum
+        self.compressor = compressor(compression, compression_level,
+                                     compression_threads)
         self.datadir = Path(datadir)
         self.backupdir = Path(backupdir)
-        self.stagedir = None
-
-    def make_staging(self):
-        """ Create the staging directory in /tmp. """
-        self.stagedir = Path("/tmp") / f"backup-{self.now}"
-        if self.debug:
-            print(f"Making staging {self.stagedir}")
-        self.stagedir.mkdir(parents=True, exist_ok=False)
-
-    def cleanup_staging(self):
-        """ Remove the staging directory if it exists. """
-        if self.stagedir is not None and self.stagedir.exists():
-            if self.debug:
-                print(f"Remove staging {self.stagedir}.")
-            rmtree(self.stagedir, ignore_errors=False)
-
-    def backup_db(self):
-        """ Make a backup of the sqlite3 database separately, using the iterdump() method for database backups. """
 
+    def backup_db(self, backup_dbfile):
+        """
+        Copy the sqlite3 database with SQLite's online backup API, page by
+        page. The copy is consistent even while vaultwarden writes to the
+        database, and is checked with integrity_check.
+        """
         data_dbfile = self.datadir / "db.sqlite3"
-        backup_dbfile = self.stagedir / "db.sqlite3"
 
-        timeout_seconds = 30  # Adjust the timeout value as needed
+        with tqdm(desc="Backing up database", unit=" pages") as progress_bar:
+            def progress(copied, total):
+                progress_bar.total = total
+                progress_bar.update(copied - progress_bar.n)
 
-        with sqlite3.connect(str(data_dbfile), timeout=timeout_seconds) as con, \
-                sqlite3.connect(str(backup_dbfile), timeout=timeout_seconds) as backup_con:
-            dump_gen = con.iterdump()
-            dump_gen_list = list(dump_gen)
-            total_commands = len(dump_gen_list)
-
-            with tqdm(total=total_commands, desc="Backing up database", unit=" commands") as progress_bar:
-                for command in dump_gen_list:
-                    if command.strip().lower() != "commit;":  # Filter out the "COMMIT;" statement
-                        with backup_con:
-                            backup_con.executescript(command)
-                    progress_bar.update(1)
-
-    def backup_everything_else(self):
-        """ Using copytree(), we make a copy of all things except the database and the staging directory. """
+            result = backup_database(str(data_dbfile), str(backup_dbfile),
+                                     self.db_pages_per_step, progress,
+                                     vacuum=self.db_vacuum)
         if self.debug:
-            print(f"Copy files from {self.datadir} to {self.stagedir}.")
-        copytree(self.datadir, self.stagedir, dirs_exist_ok=True, ignore=ignore_patterns('db.sqlite3*', 'staging'))
+            print(f"Copied {result['pages']} pages of the database in "
+                  f"{result['seconds']:.1f}s, {result['bytes']} bytes.")
 
-    def get_backup_filename(self):
-        return f"backup-vaultwarden-{self.now}.tar.bz2"
-
-    def backup_bztar(self):
-        """ Compress the staging directory into a .tar.bz2 and move to backupdir. """
+    def write_archive(self, output):
+        """
+        Write the encrypted archive of the data directory and the database
+        snapshot to output. Returns the CompressStream with the compression
+        ratio and rate.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_copy = Path(tmpdir) / "db.sqlite3"
+            self.backup_db(db_copy)
+            if self.debug:
+                print(f"Archive {self.datadir} into {output.name}.")
+            with gpg_encrypt(output, password) as encrypted, \
+                    compress(encrypted, self.compressor) as stream, \
+                    tarfile.open(fileobj=stream, mode="w|",
+                                 copybufsize=1 << 20) as tar:
+                tar.add(self.datadir, arcname=".",
+                        filter=exclude(["db.sqlite3*", "staging"]))
+                tar.add(db_copy, arcname="./db.sqlite3")
         if self.debug:
-            print(f"Archive {self.stagedir} into {self.stagedir}.tar.bz2.")
+            print(f"Compressed with {stream.summary()}.")
+        return stream
 
-        tar_filename = f"{self.stagedir.parent}/{self.stagedir.name}.tar.bz2"
-        make_archive(str(self.stagedir.parent / self.stagedir.name), "bztar", self.stagedir)
-        move(tar_filename, self.backupdir / self.get_backup_filename())
+    def get_backup_filename(self):
+        return f"backup-vaultwarden-{self.now}.tar{self.compressor.extension}.gpg"
 
-    def send_discord_message(self, filename, success=True, error_output=None):
+    def send_discord_message(self, filename, success=True, error_output=None, compression=None):
         """ Sends a Discord message. """
-        headers = {
-            "Content-Type": "application/json"
-        }
-
         if success:
             now = datetime.now(timezone('US/Eastern')).strftime(
                 "%m/%d/%Y %I:%M:%S %p %Z")
@@ -121,6 +137,11 @@ class Backup:
                     "color": 3066993
                 }]
             }
+            if compression is not None:
+                embed_data["embeds"][0]["fields"].append({
+                    "name": "Compression",
+                    "value": compression.summary()
+                })
         else:
             embed_data = {
                 "embeds": [{
@@ -130,33 +151,27 @@ class Backup:
                 }]
             }
 
-        response = requests.post(webhook_url, headers=headers, json=embed_data)
-        if response.status_code != 204:
-            print(f"Failed to send Discord message: {response.text}")
+        send_discord(webhook_url, embed_data["embeds"])
 
     def backup(self):
+        backup_file = self.backupdir / self.get_backup_filename()
+        # Only complete archives get the final name
+        partial_file = backup_file.with_name(backup_file.name + ".partial")
         try:
-            self.make_staging()
-            self.backup_everything_else()
-            self.backup_db()
-            self.backup_bztar()
-
-            # Encrypt the tar file
-            tar_file = self.backupdir / self.get_backup_filename()
-            encrypted_tar_file = tar_file.with_suffix('.tar.bz2.enc')
-            os.system(f'7z a -p{password} -y {encrypted_tar_file} {tar_file}')
-            os.remove(tar_file)
-
-            self.cleanup_staging()
-            self.send_discord_message(encrypted_tar_file.name)
+            with open(partial_file, "wb") as output:
+                stream = self.write_archive(output)
+            partial_file.replace(backup_file)
+            self.send_discord_message(backup_file.name, compression=stream)
         except Exception as e:
+            partial_file.unlink(missing_ok=True)
             error_output = str(e)
             self.send_discord_message(None, success=False, error_output=error_output)  # Send failure notification
             raise  # Re-raise the exception to show the error message in the console
 
     def expire(self, max_backups=5):
         """ Expire Backups older than the most recent max_backups (default: 5). """
-        backup_files = list(self.backupdir.glob("*.tar.bz2.enc"))
+        backup_files = [p for pattern in BACKUP_PATTERNS
+                        for p in self.backupdir.glob(pattern)]
         backup_files.sort(key=lambda p: p.stat().st_ctime, reverse=True)
 
         for idx, p in enumerate(backup_files):